@@ -1,9 +1,14 @@
 from __future__ import division
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
-from pytmatrix.tmatrix import Scatterer
-from pytmatrix.psd import PSDIntegrator, GammaPSD
-from pytmatrix import orientation, radar, tmatrix_aux, refractive
+from pytmatrix.psd import GammaPSD
+from pytmatrix import radar, tmatrix_aux, refractive
 from . import DSR
+from .utility import scattering
+from .utility.psd import normalized_gamma
+from .utility.scattering import build_scatterer
 
 class DSDProcessor:
 
@@ -23,17 +28,97 @@ class DSDProcessor:
         self.moments['Adr']      = self.moments['Ah']-radar.Ai(self.scatterer, h_pol=False)
         return self.moments
 
-    def __init__(self, wl=tmatrix_aux.wl_X, dr =1, shape='bc'):
+    def calcParametersBatch(self, D0, Nw, mu, n_workers=None,
+                            chunk_size=4096):
+        ''' Vectorized calcParameters for arrays of gamma DSD parameters.
+
+        All distributions are evaluated on the diameters of the scattering
+        table and integrated with one tensor product per chunk, instead of
+        building a GammaPSD per point. Chunks can be spread over a process
+        pool for very large parameter grids.
+
+        Parameters
+        ----------
+        D0: array_like
+            Median volume diameters [mm].
+        Nw: array_like
+            log10 of the normalized intercept parameters.
+        mu: array_like
+            Shape parameters.
+        n_workers: optional, int
+            Number of worker processes. Computed in process if None.
+        chunk_size: optional, int
+            Number of distributions integrated at once.
+
+        Returns
+        -------
+        moments: dict
+            Arrays of Zh, Zdr, delta_hv, ldr_h, ldr_v, Kdp, Ah and Adr with
+            the broadcast shape of D0, Nw and mu.
+        '''
+        D0, Nw, mu = np.broadcast_arrays(np.asarray(D0, dtype=float),
+                                         np.asarray(Nw, dtype=float),
+                                         np.asarray(mu, dtype=float))
+        shape = D0.shape
+        params = np.column_stack((D0.ravel(), Nw.ravel(), mu.ravel()))
+        chunks = [params[i:i + chunk_size]
+                  for i in range(0, len(params), chunk_size)]
+
+        if n_workers:
+            scattering.register_scatterer(self.setup, self.scatterer)
+            if 'fork' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('fork')
+            else:
+                context = None
+            with ProcessPoolExecutor(n_workers, mp_context=context) as pool:
+                results = list(pool.map(_calc_parameters_chunk,
+                                        [self.setup] * len(chunks),
+                                        [self.cache] * len(chunks), chunks))
+        else:
+            results = [_calc_parameters(self.scatterer, chunk)
+                       for chunk in chunks]
+
+        moments = {}
+        for key in ['Zh', 'Zdr', 'delta_hv', 'ldr_h', 'ldr_v', 'Kdp', 'Ah',
+                    'Adr']:
+            if results:
+                values = np.concatenate([result[key] for result in results])
+            else:
+                values = np.zeros(0)
+            moments[key] = values.reshape(shape)
+        return moments
+
+    def __init__(self, wl=tmatrix_aux.wl_X, dr =1, shape='bc', cache=None,
+                 m=None):
         DSR_list = {'tb':DSR.tb, 'bc': DSR.bc, 'pb': DSR.pb}
 
-        self.scatterer = Scatterer(wavelength=wl, m=refractive.m_w_10C[wl])
-        self.scatterer.psd_integrator = PSDIntegrator()
-        self.scatterer.psd_integrator.axis_ratio_func = lambda D: 1.0/DSR_list[shape](D)
-        self.scatterer.psd_integrator.D_max = 10.0
-        self.scatterer.psd_integrator.geometries = (tmatrix_aux.geom_horiz_back,
-                tmatrix_aux.geom_horiz_forw)
-        self.scatterer.or_pdf = orientation.gaussian_pdf(20.0)
-        self.scatterer.orient = orientation.orient_averaged_fixed
-        self.scatterer.psd_integrator.init_scatter_table(self.scatterer)
+        if m is None:
+            m = refractive.m_w_10C[wl]
+        self.setup = (wl, m, DSR_list[shape])
+        self.cache = cache
+        self.scatterer = build_scatterer(*self.setup, cache=cache)
         self.dr=dr
 
+
+def _calc_parameters_chunk(setup, cache, params):
+    return _calc_parameters(scattering.get_scatterer(setup, cache), params)
+
+
+def _calc_parameters(scatterer, params):
+    ''' Radar moments for rows of (D0, log10(Nw), mu) parameters. '''
+    psd_values = normalized_gamma(scatterer.psd_integrator._psd_D,
+                                  params[:, 0], 10 ** params[:, 1],
+                                  params[:, 2])
+    integrated = scattering.integrate_psd(scatterer, psd_values)
+    variables = scattering.radar_variables(
+        integrated, scatterer.wavelength, scatterer.Kw_sqr)
+    Z = integrated[scattering.BACK][1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ldr_h = (Z[:, 0, 0] - Z[:, 0, 1] + Z[:, 1, 0] - Z[:, 1, 1]) / \
+            (Z[:, 0, 0] - Z[:, 0, 1] - Z[:, 1, 0] + Z[:, 1, 1])
+        ldr_v = (Z[:, 0, 0] + Z[:, 0, 1] - Z[:, 1, 0] - Z[:, 1, 1]) / \
+            (Z[:, 0, 0] + Z[:, 0, 1] + Z[:, 1, 0] + Z[:, 1, 1])
+    return {'Zh': variables['Zh'], 'Zdr': variables['Zdr'],
+            'delta_hv': variables['specific_differential_phase_hv'],
+            'ldr_h': ldr_h, 'ldr_v': ldr_v, 'Kdp': variables['Kdp'],
+            'Ah': variables['Ai'], 'Adr': variables['Adr']}
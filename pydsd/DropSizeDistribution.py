@@ -7,26 +7,122 @@ simulations on itself.
 Modifications made by Eric Sulmoni
 '''
 
+import functools
+import os
+
 import numpy as np
 import pytmatrix
 import scipy
 from scipy.optimize import curve_fit
 import warnings
 
-from pytmatrix.tmatrix import Scatterer
-from pytmatrix.psd import PSDIntegrator
-from pytmatrix import orientation, radar, tmatrix_aux, refractive
 from datetime import date
 from .utility.expfit import expfit, expfit2
 
 from . import DSR
 from .utility import dielectric
 from .utility import configuration
+from .utility import scattering
+from .utility import scattering_cache
+from .utility.psd import normalized_gamma
 SPEED_OF_LIGHT = 299792458
 
+# Fields computed on first access of DropSizeDistribution.fields, with the
+# fields each one needs. Dm, Nt and W come from the cached moments.
+DERIVED_FIELDS = {
+    'N0': [], 'Nt': [], 'W': [], 'Dm': [], 'D0': [], 'Dmax': [],
+    'Nw': ['W', 'Dm'],
+    'mu': ['D0', 'Nw'],
+    'RR': [],
+}
+for _field in scattering.RADAR_FIELDS:
+    DERIVED_FIELDS[_field] = []
+
+# Scattering tables and kernels shared with the DropSizeDistributions made
+# for appended timesteps and chunks.
+SCATTERING_STATE = ['scatterer', '_scattering_key', '_scattering_kernels',
+                    'scattering_table_info', '_multiband_kernels']
+
 warnings.filterwarnings("ignore")
 
 
+class DerivedFields(dict):
+    '''
+    Dictionary of DropSizeDistribution fields that computes derived fields,
+    listed in DERIVED_FIELDS, the first time they are looked up. Fields
+    that are present are returned as is, so derived fields are memoized
+    until they are deleted or recomputed by the calculate_* methods, or
+    Nd['data'] is replaced. Membership tests and get() do not trigger any
+    computation.
+    '''
+
+    def __init__(self, dsd, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.dsd = dsd
+
+    def __getitem__(self, key):
+        self.dsd._drop_stale_fields()
+        return dict.__getitem__(self, key)
+
+    def __contains__(self, key):
+        self.dsd._drop_stale_fields()
+        return dict.__contains__(self, key)
+
+    def get(self, key, default=None):
+        self.dsd._drop_stale_fields()
+        return dict.get(self, key, default)
+
+    def __missing__(self, key):
+        if key not in DERIVED_FIELDS:
+            raise KeyError(key)
+        self.dsd._derive_field(key)
+        return dict.__getitem__(self, key)
+
+
+def _chunked(method):
+    '''
+    Run a calculate_* method chunk by chunk when chunked processing is
+    enabled, see DropSizeDistribution.set_chunking. Array arguments with
+    one row per timestep are sliced along with the chunks.
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self._drop_stale_fields()
+        if self.chunk_size is None or self.numt <= self.chunk_size or \
+                kwargs.get('scatter_time_range') is not None:
+            return method(self, *args, **kwargs)
+
+        def calculate(chunk, rows):
+            method(chunk, *[_rows(arg, rows, self.numt) for arg in args],
+                   **dict((key, _rows(value, rows, self.numt))
+                          for key, value in kwargs.items()))
+        self._calculate_chunked(calculate)
+    return wrapper
+
+
+def _rows(value, rows, numt):
+    ''' Slice rows of value when it is an array with a row per timestep. '''
+    if isinstance(value, np.ndarray) and value.ndim > 1 and \
+            len(value) == numt:
+        return value[rows]
+    return value
+
+
+class _Record(object):
+    '''
+    Reader-like container of timesteps with the size bins of an existing
+    DropSizeDistribution, used by DropSizeDistribution.append.
+    '''
+
+    def __init__(self, time, fields, dsd):
+        self.time = time
+        self.fields = fields
+        self.spread = dsd.spread
+        self.bin_edges = dsd.bin_edges
+        self.diameter = dsd.diameter
+        self.info = dsd.info
+
+
 class DropSizeDistribution(object):
 
     '''
@@ -41,8 +137,11 @@ class DropSizeDistribution(object):
             sampled in minutes relative to time_start.
         time_start: datetime
             A datetime object indicated start of disdrometer recording.
-        fields: dictionary
-            Dictionary of scattered components.
+        fields: `DerivedFields`
+            Dictionary of scattered components. Derived fields such as D0,
+            Nw, mu, RR or Zh are computed on first access, along with the
+            fields they depend on, and dropped when `Nd['data']` is
+            replaced or `invalidate_moments` is called.
         Nd : 2d Array
             A list of drop size distributions
         spread: array_like
@@ -60,10 +159,37 @@ class DropSizeDistribution(object):
             for instance, there will be 31 different bin boundaries.
         diameter: array_like
             The center size for each dsd bin.
+        scattering_stats: dict
+            Counts of spectra scattered ('misses'), spectra that repeated
+            an already scattered one ('hits') and empty spectra that were
+            skipped ('empty') by calculate_radar_parameters.
+        scattering_cache: `ScatteringTableCache`
+            On disk cache for the T-matrix scattering tables. Defaults to
+            the directory in the PYDSD_SCATTERING_CACHE environment
+            variable, or no caching when it is not set.
+        scattering_table_info: dict
+            Layout of the current scattering table: 'D_max' [mm],
+            'num_points' and the 'expected_error' of its integration over
+            the size bins, see `scattering.quadrature_error`.
+        moments: dict
+            Moments of the drop size distributions computed so far, keyed
+            by order. They are dropped when `Nd['data']` is replaced, see
+            `calculate_moments` and `invalidate_moments`.
+        storage: str
+            'masked' for float64 masked arrays or 'compact' for float32
+            arrays with NaN for masked values, see `set_storage`.
+        chunk_size: int
+            Number of timesteps processed at once by the calculate_*
+            methods, or None to process the whole record at once, see
+            `set_chunking`.
+        chunk_directory: str
+            Directory of the memory mapped Nd and calculated fields in
+            chunked processing, or None to keep them in memory.
 
     '''
 
-    def __init__(self, reader, time_start=None, location=None):
+    def __init__(self, reader, time_start=None, location=None,
+                 storage='masked'):
         '''Initializer for the DropSizeDistribution class.
 
         The DropSizeDistribution class holds dsd's returned from the various
@@ -77,6 +203,9 @@ class DropSizeDistribution(object):
             Recording Start time.
         location: tuple
             (Latitude, Longitude) pair in decimal format.
+        storage: optional, str
+            'masked' or 'compact' storage of Nd and derived fields, see
+            `set_storage`.
 
         Returns
         -------
@@ -113,7 +242,7 @@ class DropSizeDistribution(object):
             self.diameter = reader.diameter
         except:
             self.diameter = None
-        self.fields = reader.fields
+        self.fields = DerivedFields(self, reader.fields)
         self.time_start = time_start
 
         try:
@@ -127,7 +256,28 @@ class DropSizeDistribution(object):
         if location:
             self.location = {'latitude': location[0], 'longitude': location[1]}
 
+        self.scatterer = None
+        self._scattering_key = None
+        self._scattering_kernels = None
+        self.scattering_table_info = None
+        self.moments = {}
+        self._moments_Nd = None
+        self._precip_mask_cache = None
+        self._derived_fields = set()
+        self._fields_Nd = None
+        self._buffers = {}
+        self._radar_kwargs = None
+        self._rr_kwargs = None
+        self._multiband_kwargs = None
+        self._multiband_kernels = None
+        self.chunk_size = None
+        self.chunk_directory = None
+        self.storage = 'masked'
+        self.scattering_stats = {'hits': 0, 'misses': 0, 'empty': 0}
+        self.scattering_cache = scattering_cache.default_cache()
         self.set_scattering_temperature_and_frequency()
+        if storage != 'masked':
+            self.set_storage(storage)
 
     def set_scattering_temperature_and_frequency(self, scattering_temp=10.,
                                                  scattering_freq=9.7e9):
@@ -135,20 +285,35 @@ class DropSizeDistribution(object):
         calculate_radar_parameters to see the effect this has on
         the parameters. Temperatures are in Celsius. Defaults to 10C X-band.
 
+        A temperature can be given for every timestep, for instance from a
+        collocated weather station. calculate_radar_parameters then
+        interpolates between scattering tables computed on a coarse
+        temperature grid.
+
         Parameters
         ----------
-        scattering_temp: optional, float
-            Scattering temperature [C].
+        scattering_temp: optional, float or array_like
+            Scattering temperature [C], either one value or one per
+            timestep.
         scattering_freq: optional, float
             Scattering frequency [Hz].
         '''
+        if np.ndim(scattering_temp) > 0:
+            scattering_temp = np.asarray(scattering_temp, dtype=float)
+            if len(scattering_temp) != self.numt:
+                raise ValueError("Need one scattering temperature per " +
+                                 "timestep.")
         self.scattering_freq = scattering_freq
         self.scattering_temp = scattering_temp
-        self.m_w = dielectric.get_refractivity(scattering_freq,
-                                               scattering_temp)
+        self.m_w = dielectric.get_refractivity(
+            scattering_freq, np.nanmean(scattering_temp))
 
+    @_chunked
     def calculate_radar_parameters(self, dsr_func=DSR.bc,
-                                   scatter_time_range=None):
+                                   scatter_time_range=None, method='binned',
+                                   n_workers=None, executor=None,
+                                   temperature_step=5.0, fields=None,
+                                   table_accuracy=None):
         ''' Calculates radar parameters for the Drop Size Distribution.
 
         Calculates the radar parameters and stores them in the object.
@@ -159,6 +324,10 @@ class DropSizeDistribution(object):
             Adr (diff. attenuation), cross_correlation_ratio_hv (rhohv),
             LDR, Kdp
 
+        Each distinct spectrum is only scattered once and the result
+        broadcast to all timesteps where it occurs. Empty spectra are
+        skipped and masked, as there is no echo. See `scattering_stats`.
+
         Parameters:
         ----------
             wavelength: optional, pytmatrix wavelength
@@ -171,10 +340,47 @@ class DropSizeDistribution(object):
                 Parameter to restrict the scattering to a time interval.
                 The first element is the start time,
                 while the second is the end time.
+            method: optional, str
+                'binned' integrates the scattering table separately for
+                every timestep with pytmatrix. 'kernel' collapses the table
+                once into per-bin kernels for the instrument bin edges and
+                integrates all timesteps with a matrix product, which gives
+                the same results orders of magnitude faster.
+            n_workers: optional, int
+                Number of processes to split the 'binned' scattering over.
+                The time range is cut into chunks that are scattered in
+                parallel and merged back in order. dsr_func must be
+                picklable.
+            executor: optional, concurrent.futures.Executor
+                Executor to use for the parallel 'binned' scattering
+                instead of creating a process pool.
+            temperature_step: optional, float
+                Spacing [C] of the temperature grid of scattering tables
+                used when a scattering temperature is set per timestep.
+                The integrated scattering matrices of each timestep are
+                linearly interpolated between the two neighbouring tables
+                and timesteps without a finite temperature are masked.
+            fields: optional, list of str
+                Radar fields to calculate, e.g. ['Zh', 'Zdr']. Defaults to
+                all of them. The forward scattering table is neither built
+                nor integrated when none of Kdp, Ai, Av and Adr is
+                requested, and the other fields are left untouched.
+            table_accuracy: optional, float
+                Target relative integration error per size bin. When given,
+                the scattering table D_max and number of diameters are
+                chosen from the bin edges to reach it, so coarse bins get
+                small, fast tables and fine bins get dense ones. Defaults
+                to a fixed 1024 point table up to 10 mm. The resulting
+                layout is reported in `scattering_table_info`.
         '''
-        self._setup_scattering(SPEED_OF_LIGHT/self.scattering_freq *
-                               1000.0, dsr_func)
-        self._setup_empty_fields()
+        geometries = scattering.field_geometries(fields)
+        if fields is None:
+            fields = scattering.RADAR_FIELDS
+        self._setup_empty_fields(fields)
+        self._radar_kwargs = {'dsr_func': dsr_func, 'method': method,
+                              'n_workers': n_workers, 'executor': executor,
+                              'temperature_step': temperature_step,
+                              'table_accuracy': table_accuracy}
 
         if scatter_time_range is None:
             self.scatter_start_time = 0
@@ -191,71 +397,281 @@ class DropSizeDistribution(object):
                       "Scattering to end of included time.")
                 self.scatter_end_time = self.numt
 
-        # We break up scattering to avoid regenerating table.
-        self.scatterer.set_geometry(tmatrix_aux.geom_horiz_back)
-        
-        print('Calculating backward scattering parameters ...')
-        for t in range(self.scatter_start_time, self.scatter_end_time):
-            if np.sum(self.Nd['data'][t]) is 0:
-                continue
-            BinnedDSD = pytmatrix.psd.BinnedPSD(self.bin_edges['data'],
-                                                self.Nd['data'][t])
-            self.scatterer.psd = BinnedDSD
-            self.fields['Zh']['data'][t] = 10 * \
-                np.log10(radar.refl(self.scatterer))
-            self.fields['Zv']['data'][t] = 10 * \
-                np.log10(radar.refl(self.scatterer, h_pol=False))
-            self.fields['Zdr']['data'][t] = 10 * \
-                np.log10(radar.Zdr(self.scatterer))
-            self.fields['cross_correlation_ratio_hv']['data'][t] = \
-                radar.rho_hv(self.scatterer)
-            self.fields['specific_differential_phase_hv']['data'][t] = \
-                radar.delta_hv(self.scatterer)
-            self.fields['LDR']['data'][t] = 10 * \
-                np.log10(radar.ldr(self.scatterer))
-
-        self.scatterer.set_geometry(tmatrix_aux.geom_horiz_forw)
-        
-        print('Calculating forward scattering parameters ...')
-        for t in range(self.scatter_start_time, self.scatter_end_time):
-            BinnedDSD = pytmatrix.psd.BinnedPSD(self.bin_edges['data'],
-                                                self.Nd['data'][t])
-            self.scatterer.psd = BinnedDSD
-            self.fields['Kdp']['data'][t] = radar.Kdp(self.scatterer)
-            self.fields['Ai']['data'][t] = radar.Ai(self.scatterer)
-            self.fields['Av']['data'][t] = radar.Ai(self.scatterer, h_pol=False)
-            self.fields['Adr']['data'][t] = radar.Ai(self.scatterer) - \
-                radar.Ai(self.scatterer, h_pol=False)
+        wavelength = SPEED_OF_LIGHT/self.scattering_freq * 1000.0
+        time_slice = slice(self.scatter_start_time, self.scatter_end_time)
+        Nd = self.Nd['data'][time_slice]
+        if np.ndim(self.scattering_temp) == 0:
+            self._setup_scattering(wavelength, dsr_func,
+                                   geometries=geometries,
+                                   table_accuracy=table_accuracy)
+            rows, integrated = self._integrate_spectra(
+                Nd, method, n_workers, executor, geometries)
+            no_temperature = None
+        else:
+            rows, integrated, no_temperature = \
+                self._integrate_spectra_temperature(
+                    Nd, self.scattering_temp[time_slice], wavelength,
+                    dsr_func, temperature_step, method, n_workers, executor,
+                    geometries, table_accuracy)
+
+        variables = scattering.radar_variables(
+            integrated, wavelength, self.scatterer.Kw_sqr, fields)
+        for param, values in variables.items():
+            self.fields[param]['data'][self.scatter_start_time + rows] = \
+                values
+            if no_temperature is not None:
+                self.fields[param]['data'][self.scatter_start_time +
+                                           np.nonzero(no_temperature)[0]] = \
+                    np.ma.masked
 
         # Mask all values where no precipitation present or when ice present
-        params_list = ['Zh', 'Zv', 'Zdr', 'Kdp', 'Ai', 'Av',
-                       'Adr', 'cross_correlation_ratio_hv', 'LDR',
-                       'specific_differential_phase_hv']
-        l = np.empty(len(self.fields['Precip_Code']['data']),dtype=bool)
-        j = 0
-        for i in self.fields['Precip_Code']['data']:
-            l[j] = 'N' in i or 'G' in i
-            j += 1       
-        for param in params_list:
-            self.fields[param]['data'] = \
-                np.ma.masked_where(l, self.fields[param]['data'])
-
-    def _setup_empty_fields(self):
+        l = self._precip_mask().copy()
+        empty = np.ones(len(Nd), dtype=bool)
+        empty[rows] = False
+        l[self.scatter_start_time + np.nonzero(empty)[0]] = True
+        for param in fields:
+            self._store_field(param, self.fields[param]['data'], l)
+
+    def _integrate_spectra(self, Nd, method, n_workers=None, executor=None,
+                           geometries=None):
+        ''' Integrate the current scattering table over the spectra Nd.
+
+        Each distinct non-empty spectrum is integrated once, for the given
+        geometries or all geometries of the table.
+
+        Returns:
+        --------
+            rows: array
+                Indices of the non-empty rows of Nd.
+            integrated: dict
+                Maps geometries to (S, Z) arrays for those rows.
+        '''
+        numt = len(Nd)
+        rows, Nd, inverse = scattering.unique_spectra(Nd)
+        self.scattering_stats['empty'] += numt - len(rows)
+        self.scattering_stats['misses'] += len(Nd)
+        self.scattering_stats['hits'] += len(rows) - len(Nd)
+        if geometries is None:
+            geometries = self.scatterer.psd_integrator.geometries
+
+        if method == 'kernel':
+            if self._scattering_kernels is None:
+                self._scattering_kernels = scattering.bin_kernels(
+                    self.scatterer, self.bin_edges['data'])
+            integrated = scattering.integrate_kernels(
+                self._scattering_kernels, Nd, geometries)
+        elif method == 'binned' and (n_workers or executor):
+            print('Calculating scattering parameters in parallel ...')
+            scattering.register_scatterer(self._scattering_key,
+                                          self.scatterer)
+            integrated = scattering.integrate_binned_parallel(
+                self._scattering_key, self.bin_edges['data'], Nd,
+                geometries, n_workers=n_workers, executor=executor,
+                cache=self.scattering_cache)
+        elif method == 'binned':
+            # We break up scattering to avoid regenerating table.
+            print('Calculating scattering parameters ...')
+            integrated = scattering.integrate_binned(
+                self.scatterer, self.bin_edges['data'], Nd, geometries)
+        else:
+            raise ValueError("Unknown scattering method: %s" % method)
+
+        for geom, (S, Z) in integrated.items():
+            integrated[geom] = (S[inverse], Z[inverse])
+        return rows, integrated
+
+    def _integrate_spectra_temperature(self, Nd, temperature, wavelength,
+                                       dsr_func, temperature_step, method,
+                                       n_workers=None, executor=None,
+                                       geometries=(scattering.BACK,
+                                                   scattering.FORW),
+                                       table_accuracy=None):
+        ''' Integrate the spectra Nd at a temperature per timestep.
+
+        Scattering tables are set up on a grid of temperatures spaced by
+        temperature_step. Each timestep is integrated with the two tables
+        bracketing its temperature and the results are linearly
+        interpolated.
+
+        Returns:
+        --------
+            rows: array
+                Indices of the rows of Nd that were integrated.
+            integrated: dict
+                Maps geometries to (S, Z) arrays for those rows.
+            no_temperature: array
+                Boolean array flagging rows without a finite temperature.
+        '''
+        no_temperature = ~np.isfinite(temperature)
+        valid = np.nonzero(~no_temperature)[0]
+        if len(valid) == 0:
+            raise ValueError("No finite scattering temperature in the " +
+                             "scattering time range.")
+        T = temperature[valid]
+        t_min = np.floor(T.min() / temperature_step) * temperature_step
+        grid = t_min + temperature_step * np.arange(
+            int(np.ceil((T.max() - t_min) / temperature_step)) + 1)
+        if len(grid) == 1:
+            grid = np.append(grid, grid[0] + temperature_step)
+        lower = np.minimum(((T - t_min) // temperature_step).astype(int),
+                           len(grid) - 2)
+        weight = (T - grid[lower]) / temperature_step
+
+        n = len(valid)
+        acc = {geom: (np.zeros((n, 2, 2), dtype=complex),
+                      np.zeros((n, 4, 4)))
+               for geom in geometries}
+        nonempty = np.zeros(n, dtype=bool)
+        for i, temp in enumerate(grid):
+            # Rows interpolating from this table and their weights.
+            needed = np.nonzero((lower == i) | (lower == i - 1))[0]
+            if len(needed) == 0:
+                continue
+            w = np.where(lower[needed] == i, 1 - weight[needed],
+                         weight[needed])
+            self._setup_scattering(
+                wavelength, dsr_func,
+                dielectric.get_refractivity(self.scattering_freq, temp),
+                geometries, table_accuracy)
+            rows, integrated = self._integrate_spectra(
+                Nd[valid[needed]], method, n_workers, executor, geometries)
+            nonempty[needed[rows]] = True
+            for geom, (S, Z) in integrated.items():
+                acc[geom][0][needed[rows]] += \
+                    w[rows, np.newaxis, np.newaxis] * S
+                acc[geom][1][needed[rows]] += \
+                    w[rows, np.newaxis, np.newaxis] * Z
+
+        for geom, (S, Z) in acc.items():
+            acc[geom] = (S[nonempty], Z[nonempty])
+        return valid[nonempty], acc, no_temperature
+
+    @_chunked
+    def calculate_radar_parameters_multiband(self, frequencies,
+                                             temperatures=None,
+                                             dsr_func=DSR.bc, suffixes=None,
+                                             n_workers=None):
+        ''' Calculates radar parameters at several frequencies in one pass.
+
+        Builds the scattering tables for all frequencies, concurrently when
+        n_workers is given, collapses them into bin kernels and scatters
+        the whole record for every band. The results are stored in band
+        suffixed fields, e.g. Zh_S, Zh_X, Kdp_Ka, next to the fields of
+        calculate_radar_parameters which are left untouched.
+
+        Parameters:
+        ----------
+            frequencies: list of float
+                Scattering frequencies [Hz].
+            temperatures: optional, float or list of float
+                Scattering temperatures [C], one per frequency. Defaults to
+                the current scattering temperature, or its mean when it is
+                set per timestep.
+            dsr_func: optional, function
+                Drop Shape Relationship function. Several are available
+                in the `DSR` module.
+                Defaults to Beard and Chuang
+            suffixes: optional, list of str
+                Field suffix for each frequency. Defaults to the radar band
+                letter of each frequency.
+            n_workers: optional, int
+                Number of processes used to build the scattering tables.
+        '''
+        if temperatures is None:
+            temperatures = float(np.nanmean(self.scattering_temp))
+        if np.isscalar(temperatures):
+            temperatures = [temperatures] * len(frequencies)
+        if suffixes is None:
+            suffixes = [scattering.frequency_band(freq)
+                        for freq in frequencies]
+        if len(set(suffixes)) != len(suffixes):
+            raise ValueError("Several frequencies fall in the same band, " +
+                             "please provide unique suffixes.")
+
+        setups = [(SPEED_OF_LIGHT / freq * 1000.0,
+                   dielectric.get_refractivity(freq, temp), dsr_func)
+                  for freq, temp in zip(frequencies, temperatures)]
+        if self._multiband_kernels is not None and \
+                self._multiband_kernels[0] == setups:
+            kernels = self._multiband_kernels[1]
+        else:
+            kernels = scattering.build_kernels(
+                setups, self.bin_edges['data'], n_workers=n_workers,
+                cache=self.scattering_cache)
+            self._multiband_kernels = (setups, kernels)
+        self._multiband_kwargs = {'frequencies': frequencies,
+                                  'temperatures': temperatures,
+                                  'dsr_func': dsr_func, 'suffixes': suffixes}
+
+        l = self._precip_mask().copy()
+        rows, Nd, inverse = scattering.unique_spectra(self.Nd['data'])
+        # Empty spectra have no echo.
+        empty = np.ones(self.numt, dtype=bool)
+        empty[rows] = False
+        l |= empty
+        for setup, (kernel, Kw_sqr), freq, temp, suffix in zip(
+                setups, kernels, frequencies, temperatures, suffixes):
+            integrated = scattering.integrate_kernels(kernel, Nd)
+            variables = scattering.radar_variables(integrated, setup[0],
+                                                   Kw_sqr)
+            for param, values in variables.items():
+                data = np.zeros(self.numt)
+                data[rows] = values[inverse]
+                field = self._store_field(param + '_' + suffix, data, l,
+                                          metadata=param)
+                field['frequency'] = freq
+                field['temperature'] = temp
+
+    def _precip_mask(self):
+        ''' Mask of timesteps without precipitation or with ice present.
+
+        Precipitation codes containing 'N' (no precipitation, snow) or 'G'
+        (graupel, snow grains) are masked. Each distinct code is tested
+        once and the mask is cached until the Precip_Code data is
+        replaced. Nothing is masked when there is no Precip_Code field,
+        nor for missing codes.
+        '''
+        code = self.fields.get('Precip_Code')
+        if code is None:
+            return np.zeros(self.numt, dtype=bool)
+        if self._precip_mask_cache is not None and \
+                self._precip_mask_cache[0] is code['data']:
+            return self._precip_mask_cache[1]
+
+        if 'flag_meanings' in code:
+            categories = np.array(code['flag_meanings'].split())
+            lookup = np.zeros(256, dtype=bool)
+            lookup[np.asarray(code['flag_values'])] = \
+                [('N' in c or 'G' in c) for c in categories]
+            l = lookup[np.ma.filled(code['data'], 0)]
+            l[np.ma.getmaskarray(code['data'])] = False
+        else:
+            categories, inverse = np.unique(
+                np.asarray(code['data']).astype(str), return_inverse=True)
+            l = np.array([('N' in c or 'G' in c) for c in categories],
+                         dtype=bool)[inverse.ravel()]
+        self._precip_mask_cache = (code['data'], l)
+        return l
+
+    def _setup_empty_fields(self, fields=None):
         ''' Preallocate arrays of zeros for the radar moments
         '''
-        params_list = ['Zh', 'Zv', 'Zdr', 'Kdp', 'Ai', 'Av',
-                       'Adr', 'cross_correlation_ratio_hv', 'LDR',
-                       'specific_differential_phase_hv']
-        for param in params_list:
+        if fields is None:
+            fields = scattering.RADAR_FIELDS
+        for param in fields:
             self.fields[param] = \
                 self.config.fill_in_metadata(param, np.ma.zeros(self.numt))
 
-    def _setup_scattering(self, wavelength, dsr_func):
+    def _setup_scattering(self, wavelength, dsr_func, m=None,
+                          geometries=(scattering.BACK, scattering.FORW),
+                          table_accuracy=None):
         ''' Internal Function to create scattering tables.
 
         This internal function sets up the scattering table. It takes a
         wavelength as an argument where wavelength is one of the pytmatrix
-        accepted wavelengths.
+        accepted wavelengths. The table is reused while wavelength,
+        refractive index and DSR are unchanged, and is read from and
+        written to `scattering_cache` when one is set.
 
         Parameters:
         -----------
@@ -264,20 +680,100 @@ class DropSizeDistribution(object):
             dsr_func : function
                 Drop Shape Relationship function. Several built-in
                 are available in the `DSR` module.
+            m : optional, complex
+                Refractive index of water. Defaults to m_w.
+            geometries : optional, tuple
+                Scattering geometries the table must hold. A table that
+                already holds them is reused.
+            table_accuracy : optional, float
+                Target relative integration error used to choose the table
+                layout from the bin edges. Defaults to the fixed layout.
 
         '''
-        self.scatterer = Scatterer(wavelength=wavelength,
-                                   m=self.m_w)
-        self.scatterer.psd_integrator = PSDIntegrator()
-        self.scatterer.psd_integrator.axis_ratio_func = lambda D: 1.0 / \
-            dsr_func(D)
+        if m is None:
+            m = self.m_w
+        if table_accuracy is None:
+            D_max = scattering.DEFAULT_D_MAX
+            num_points = scattering.DEFAULT_NUM_POINTS
+            error = scattering.quadrature_error(self.bin_edges['data'],
+                                                D_max, num_points)
+        else:
+            D_max, num_points, error = scattering.table_resolution(
+                self.bin_edges['data'], table_accuracy)
+        self.scattering_table_info = {'D_max': D_max,
+                                      'num_points': num_points,
+                                      'expected_error': error}
+
+        key = (wavelength, m, dsr_func, D_max,
+               scattering.DEFAULT_CANTING_STD, num_points)
+        if self.scatterer is not None and key == self._scattering_key and \
+                set(geometries) <= \
+                set(self.scatterer.psd_integrator.geometries):
+            return
+        self.scatterer = scattering.build_scatterer(
+            *key, cache=self.scattering_cache, geometries=geometries)
         self.dsr_func = dsr_func
-        self.scatterer.psd_integrator.D_max = 10.0
-        self.scatterer.psd_integrator.geometries = (
-            tmatrix_aux.geom_horiz_back, tmatrix_aux.geom_horiz_forw)
-        self.scatterer.or_pdf = orientation.gaussian_pdf(20.0)
-        self.scatterer.orient = orientation.orient_averaged_fixed
-        self.scatterer.psd_integrator.init_scatter_table(self.scatterer)
+        self._scattering_key = key
+        self._scattering_kernels = None
+
+    def calculate_moments(self, orders=range(0, 8)):
+        '''Calculates moments of the drop size distributions.
+
+        All requested orders are computed for all timesteps with a single
+        matrix product Nd @ (D**m * dD). Results are kept in `moments`
+        and reused until `Nd['data']` is replaced. Call
+        `invalidate_moments` after modifying Nd in place. The columns can
+        be passed on to the moment based fits, e.g.
+        `fit.ua98.shape(*dsd.calculate_moments([2, 4, 6]).T)`.
+
+        Parameters:
+        -----------
+        orders: optional, list of float
+            Orders of the moments. Defaults to 0 through 7.
+
+        Returns:
+        --------
+        moments: 2d array
+            Moment matrix, one row per timestep and one column per order.
+        '''
+        if self._moments_Nd is not self.Nd['data']:
+            self.moments = {}
+            self._moments_Nd = self.Nd['data']
+
+        orders = list(orders)
+        missing = [m for m in orders if m not in self.moments]
+        if missing:
+            D = np.asarray(self.diameter['data'], dtype=float)
+            weights = np.power.outer(D, np.asarray(missing, dtype=float)) * \
+                self._bin_width()[:, np.newaxis]
+            values = np.dot(np.ma.filled(self.Nd['data'], 0), weights)
+            for i, m in enumerate(missing):
+                self.moments[m] = values[:, i]
+        return np.column_stack([self.moments[m] for m in orders])
+
+    def invalidate_moments(self):
+        '''Drops the cached moments of the drop size distributions, and
+        the derived fields on their next access.'''
+        self.moments = {}
+        self._moments_Nd = None
+        self._fields_Nd = None
+
+    def _drop_stale_fields(self):
+        ''' Drop the derived fields when Nd['data'] was replaced, or
+        `invalidate_moments` called, since they were calculated.
+        '''
+        if self._fields_Nd is self.Nd['data']:
+            return
+        for name in self._derived_fields:
+            dict.pop(self.fields, name, None)
+        self._derived_fields = set()
+        self._fields_Nd = self.Nd['data']
+
+    def _bin_width(self):
+        '''Width of each size bin, from spread or else from bin_edges.'''
+        if len(self.spread['data']) > 0:
+            return np.asarray(self.spread['data'], dtype=float)
+        return np.diff(np.asarray(self.bin_edges['data'], dtype=float))
 
     def _calc_mth_moment(self, m):
         '''Calculates the mth moment of the drop size distribution.
@@ -289,22 +785,9 @@ class DropSizeDistribution(object):
         m: float
             order of the moment
         '''
+        return np.ma.array(self.calculate_moments([m])[:, 0])
 
-        if len(self.spread['data']) > 0:
-            bin_width = self.spread['data']
-        else:
-            bin_width = [self.bin_edges['data'][i + 1] -
-                         self.bin_edges['data'][i]
-                         for i in range(0, len(self.bin_edges['data']) - 1)]
-        mth_moment = np.ma.zeros(self.numt)
-
-        for t in range(0, self.numt):
-            dmth = np.power(self.diameter['data'], m)
-            mth_moment[t] = np.dot(
-                np.multiply(dmth, self.Nd['data'][t]), bin_width)
-
-        return mth_moment
-
+    @_chunked
     def calculate_dsd_parameterization(self, method='bringi'):
         '''Calculates DSD Parameterization.
 
@@ -325,65 +808,646 @@ class DropSizeDistribution(object):
 
         '''
 
-        params_list = ['D0', 'Dmax', 'Dm', 'Nt', 'Nw', 'N0', 'W', 'mu']
+        # In dependency order, so that no stale field is used.
+        for param in ['N0', 'Dm', 'Nt', 'W', 'D0', 'Nw', 'Dmax', 'mu']:
+            self._derive_field(param)
 
-        for param in params_list:
-            self.fields[param] = \
-                self.config.fill_in_metadata(param, np.ma.zeros(self.numt))
+    def _derive_field(self, name):
+        ''' Compute the derived field name and store it in fields.
+
+        The fields it depends on according to DERIVED_FIELDS are looked up
+        first, which computes them if they are missing. Radar fields are
+        calculated with the other fields of the same scattering geometry,
+        so the scattering table is integrated only once for them.
+
+        Parameters:
+        -----------
+        name: str
+            Name of a field in DERIVED_FIELDS.
+        '''
+        if self.chunk_size is not None and self.numt > self.chunk_size:
+            self._calculate_chunked(lambda chunk, rows: chunk.fields[name])
+            return
+        for dep in DERIVED_FIELDS[name]:
+            self.fields[dep]
+
+        if name in scattering.BACKWARD_FIELDS:
+            self.calculate_radar_parameters(fields=scattering.BACKWARD_FIELDS)
+            return
+        if name in scattering.FORWARD_FIELDS:
+            self.calculate_radar_parameters(fields=scattering.FORWARD_FIELDS)
+            return
+        if name == 'RR':
+            self.calculate_RR()
+            return
 
         rho_w = 1e-03  # grams per mm cubed Density of Water
-        vol_constant = np.pi / 6.0 * rho_w
-        self.fields['Dm']['data'] = np.divide(self._calc_mth_moment(4),
-                                              self._calc_mth_moment(3))
-        for t in range(0, self.numt):
-            if np.sum(self.Nd['data'][t]) == 0:
-                continue
-            self.fields['Nt']['data'][t] = \
-                np.dot(self.spread['data'], self.Nd['data'][t])
-            self.fields['W']['data'][t] = \
-                vol_constant * np.dot(
-                    np.multiply(self.Nd['data'][t], self.spread['data']),
-                    np.array(self.diameter['data']) ** 3)
-            self.fields['D0']['data'][t] = \
-                self._calculate_D0(self.Nd['data'][t])
-            self.fields['Nw']['data'][t] = 256.0 / \
-                (np.pi * rho_w) * np.divide(self.fields['W']['data'][t],
-                                            self.fields['Dm']['data'][t] ** 4)
-
-            self.fields['Dmax']['data'][t] = \
-                self.__get_last_nonzero(self.Nd['data'][t])
-
-        self.fields['mu']['data'][:] = list(map(self._estimate_mu,
-                                                list(range(0, self.numt))))
+        if name == 'N0':
+            data = np.zeros(self.numt)
+        elif name == 'Dm':
+            M3, M4 = self.calculate_moments([3, 4]).T
+            data = np.ma.divide(M4, M3)
+        elif name == 'Nt':
+            data = self.calculate_moments([0])[:, 0]
+        elif name == 'W':
+            vol_constant = np.pi / 6.0 * rho_w
+            data = vol_constant * self.calculate_moments([3])[:, 0]
+        elif name == 'D0':
+            data = self._calculate_D0_batch(self.Nd['data'])
+        elif name == 'Nw':
+            data = np.zeros(self.numt)
+            rows = self._nonempty()
+            W = np.ma.filled(self.fields['W']['data'], np.nan)[rows]
+            Dm = np.ma.filled(self.fields['Dm']['data'], np.nan)[rows]
+            data[rows] = 256.0 / (np.pi * rho_w) * np.divide(W, Dm ** 4)
+        elif name == 'Dmax':
+            data = self._calculate_Dmax_batch()
+        elif name == 'mu':
+            data = self._estimate_mu_batch()
 
         # Mask all values where no precipitation present or when ice present
-        l = np.empty(len(self.fields['Precip_Code']['data']),dtype=bool)
-        j = 0
-        for i in self.fields['Precip_Code']['data']:
-            l[j] = 'N' in i or 'G' in i
-            j += 1
-        for param in params_list:
-            self.fields[param]['data'] = \
-                np.ma.masked_where(l, self.fields[param]['data'])
-
-    def __get_last_nonzero(self, N):
-        ''' Gets last nonzero entry in an array. Gets last non-zero entry in an array.
+        self._store_field(name, data, self._precip_mask())
 
-        Parameters
-        ----------
-        N: array_like
-            Array to find nonzero entry in
+    def _store_field(self, name, data, mask=None, metadata=None):
+        ''' Store data as the field name in the current storage mode.
 
-        Returns
-        -------
-        max: int
-            last nonzero entry in an array.
+        Parameters:
+        -----------
+        name: str
+            Name of the field.
+        data: array_like
+            Field values. Stored without copying in 'masked' storage, so
+            it must not be shared with other fields.
+        mask: optional, array_like
+            Boolean array of values to mask.
+        metadata: optional, str
+            Metadata configuration entry to use, defaults to name. Fields
+            without an entry only get their data.
+
+        Returns:
+        --------
+        field: dict
+            The stored field dictionary.
+        '''
+        if self.storage == 'compact':
+            data = self._compact(data)
+            if mask is not None:
+                data[np.asarray(mask)] = np.nan
+        elif mask is not None:
+            data = np.ma.masked_where(mask, data)
+        else:
+            data = np.ma.asarray(data)
+
+        metadata = name if metadata is None else metadata
+        if metadata in self.config.metadata:
+            field = self.config.fill_in_metadata(metadata, data,
+                                                 copy_data=False)
+        else:
+            field = {'data': data}
+        self.fields[name] = field
+        self._derived_fields.add(name)
+        return field
+
+    @staticmethod
+    def _compact(data, fill_value=np.nan):
+        ''' float32 copy of data with masked values set to fill_value. '''
+        return np.ma.filled(np.ma.array(data, dtype=np.float32, copy=True),
+                            fill_value)
+
+    def set_storage(self, storage):
+        ''' Select how Nd and the derived fields are stored.
+
+        'masked' (the default) keeps float64 numpy masked arrays. 'compact'
+        stores plain float32 arrays, using NaN for masked values and 0 for
+        masked Nd entries. This halves memory use and avoids the overhead
+        of masked array operations on long records. Calculations are still
+        done in float64, only the stored results are rounded: float32 has
+        a relative precision of about 6e-8 (7 significant digits), far
+        below the measurement uncertainty of any disdrometer.
+
+        Existing Nd and float fields are converted to the new storage.
+
+        Parameters:
+        -----------
+        storage: str
+            'masked' or 'compact'.
         '''
+        if storage not in ('masked', 'compact'):
+            raise ValueError("Unknown storage: %s" % storage)
+        self.storage = storage
+        self._drop_stale_fields()
+        fields = [self.Nd] + [field for field in self.fields.values()
+                              if field is not self.Nd]
+        for field in fields:
+            data = field.get('data') if isinstance(field, dict) else None
+            if data is None or np.ndim(data) == 0 or \
+                    np.asarray(data).dtype.kind != 'f':
+                continue
+            if storage == 'compact':
+                field['data'] = self._compact(
+                    data, 0.0 if field is self.Nd else np.nan)
+            elif not np.ma.isMaskedArray(data):
+                field['data'] = np.ma.masked_invalid(
+                    np.asarray(data, dtype=float))
+        # The derived fields were converted along with Nd.
+        self._fields_Nd = self.Nd['data']
+
+    def append(self, samples):
+        ''' Append timesteps to the end of the record.
+
+        Meant for real time processing, where a new telegram arrives every
+        few seconds. time, Nd and the other per timestep fields become
+        views on buffers whose capacity is doubled when they are full, so
+        appending costs amortized O(1) per timestep instead of copying the
+        whole record. Derived fields, cached moments and radar variables
+        that were calculated before are computed for the new timesteps
+        only, with the settings of their last calculation, and appended.
 
-        if np.ma.count(N):
-            return self.diameter['data'][np.max(N.nonzero())]
+        Parameters:
+        -----------
+        samples: dict or `DropSizeDistribution`
+            The new timesteps. A dict maps 'time', 'Nd' and optionally
+            other measured fields, such as 'Precip_Code',
+            'terminal_velocity' or 'scattering_temp', to arrays or field
+            dictionaries with one row per timestep. A DropSizeDistribution
+            with the same size bins, e.g. read from the latest telegrams,
+            is appended with its time and measured fields. Measured fields
+            missing from samples are masked for the new timesteps and
+            fields the record does not have are ignored.
+        '''
+        from .io.common import decode_categorical
+
+        self._drop_stale_fields()
+        if isinstance(samples, DropSizeDistribution):
+            new = dict((name, field) for name, field in samples.fields.items()
+                       if name not in samples._derived_fields)
+            new['time'] = samples.time
+            if np.ndim(samples.scattering_temp) > 0:
+                new['scattering_temp'] = samples.scattering_temp
         else:
-            return 0
+            new = dict(samples)
+        for name, field in new.items():
+            if not isinstance(field, dict):
+                new[name] = {'data': field}
+        if 'Nd' not in new or 'time' not in new:
+            raise ValueError("Samples need both time and Nd.")
+        Nd = np.ma.atleast_2d(np.ma.asarray(new['Nd']['data'], dtype=float))
+        n = len(Nd)
+        if Nd.shape[1] != np.shape(self.Nd['data'])[1] or \
+                len(new['time']['data']) != n:
+            raise ValueError("Samples need one time and a spectrum with " +
+                             "the size bins of the record per timestep.")
+        if 'RR' in self._derived_fields and \
+                np.ndim(self._rr_kwargs['velocity']) > 1:
+            raise ValueError("RR was calculated with per timestep " +
+                             "velocities, recalculate it after appending.")
+
+        old = self.numt
+        per_timestep = [name for name, field in self.fields.items()
+                        if isinstance(field, dict) and
+                        np.ndim(field.get('data')) > 0 and
+                        len(field['data']) == old]
+        derived = [name for name in per_timestep
+                   if name in self._derived_fields]
+        measured = [name for name in per_timestep
+                    if name not in self._derived_fields]
+
+        # Scatter and derive the new timesteps on their own, before the
+        # record is touched.
+        record_fields = {'Nd': {'data': Nd}}
+        for name in measured:
+            if name in new and name != 'Nd':
+                record_fields[name] = dict(new[name])
+        if 'Precip_Code' in record_fields:
+            record_fields['Precip_Code'] = {'data': np.char.strip(
+                decode_categorical(new['Precip_Code']).astype(str))}
+        temperature = self.scattering_temp
+        if np.ndim(temperature) > 0:
+            temperature = new.get('scattering_temp', {'data': np.nan})
+            temperature = np.broadcast_to(np.asarray(
+                temperature['data'], dtype=float), (n,))
+        part = self._like(new['time'], record_fields, temperature)
+
+        radar = [name for name in derived
+                 if name in scattering.RADAR_FIELDS]
+        if radar:
+            part.calculate_radar_parameters(fields=radar,
+                                            **self._radar_kwargs)
+        if self._multiband_kwargs is not None and \
+                any(name not in DERIVED_FIELDS for name in derived):
+            part.calculate_radar_parameters_multiband(
+                **self._multiband_kwargs)
+        if 'RR' in derived:
+            part.calculate_RR(**self._rr_kwargs)
+        for name in derived:
+            if name in DERIVED_FIELDS:
+                part.fields[name]
+
+        # Grow the record.
+        moments = self._moments_Nd is self.Nd['data']
+        mask_cache = self._precip_mask_cache
+        if mask_cache is not None and (
+                'Precip_Code' not in self.fields or
+                mask_cache[0] is not self.fields['Precip_Code']['data']):
+            mask_cache = None
+        # Looked up before Nd grows, which would drop the derived fields.
+        fields = [(name, self.fields[name]) for name in per_timestep]
+        for name, field in fields:
+            if name in derived:
+                values = part.fields[name]['data'] \
+                    if name in part.fields else None
+            elif name == 'Nd':
+                values = part.Nd['data']
+            elif name == 'Precip_Code':
+                codes = part.fields['Precip_Code']['data'] \
+                    if 'Precip_Code' in part.fields else np.array([''] * n)
+                values = self._encode_categories(field, codes)
+            else:
+                values = new[name]['data'] if name in new else None
+            if values is None:
+                values = np.ma.masked_all((n,) + np.shape(field['data'])[1:],
+                                          np.asarray(field['data']).dtype)
+                if self.storage == 'compact' and \
+                        values.dtype.kind == 'f' and \
+                        not np.ma.isMaskedArray(field['data']):
+                    values = values.filled(np.nan)
+            field['data'] = self._append_rows(('fields', name), field['data'],
+                                              values)
+        self.time['data'] = self._append_rows(('time',), self.time['data'],
+                                              part.time['data'])
+        if np.ndim(self.scattering_temp) > 0:
+            self.scattering_temp = self._append_rows(
+                ('scattering_temp',), self.scattering_temp,
+                part.scattering_temp)
+        self.numt = old + n
+        self._fields_Nd = self.Nd['data']
+
+        if moments:
+            orders = list(self.moments)
+            values = part.calculate_moments(orders)
+            for i, m in enumerate(orders):
+                self.moments[m] = self._append_rows(
+                    ('moments', m), self.moments[m], values[:, i])
+            self._moments_Nd = self.Nd['data']
+        if mask_cache is not None:
+            self._precip_mask_cache = (
+                self.fields['Precip_Code']['data'],
+                self._append_rows(('precip_mask',), mask_cache[1],
+                                  part._precip_mask()))
+
+        self._adopt_scattering(part)
+
+    @classmethod
+    def concatenate(cls, dsds):
+        ''' Merge records of the same size bins into one, sorted by time.
+
+        Timesteps are sorted by time, with a stable sort, and of timesteps
+        with equal times only the first one, in the order of dsds, is kept.
+        Each per timestep measured field is copied once into an array
+        allocated for the merged record. Fields missing from some of the
+        records are masked for their timesteps. Derived fields and radar
+        variables are not merged, they are computed again on access or by
+        the calculate_* methods.
+
+        Parameters:
+        -----------
+        dsds: list of `DropSizeDistribution`
+            Records to merge. The first one provides the size bins, the
+            metadata and the storage mode of the merged record.
+
+        Returns:
+        --------
+        dsd: `DropSizeDistribution`
+            The merged record.
+        '''
+        from .io.common import categorical_to_dict, decode_categorical
+
+        dsds = list(dsds)
+        if not dsds:
+            raise ValueError("No records to concatenate.")
+        first = dsds[0]
+        for dsd in dsds[1:]:
+            if not cls._same_bins(first, dsd):
+                raise ValueError("Records have different size bins.")
+
+        times = [np.asarray(dsd.time['data']) for dsd in dsds]
+        offsets = np.cumsum([0] + [len(time) for time in times])
+        time = np.concatenate(times)
+        order = np.argsort(time, kind='stable')
+        keep = np.ones(len(order), dtype=bool)
+        keep[1:] = time[order[1:]] != time[order[:-1]]
+        order = order[keep]
+        # Source record and row of each merged timestep.
+        source = np.searchsorted(offsets, order, side='right') - 1
+        rows = [(np.flatnonzero(source == k), order[source == k] - offsets[k])
+                for k in range(len(dsds))]
+
+        def merge(arrays):
+            present = [data for data in arrays if data is not None]
+            masked = len(present) < len(arrays) or \
+                any(np.ma.isMaskedArray(data) for data in present)
+            dtype = np.result_type(*[np.asarray(data).dtype
+                                     for data in present])
+            shape = (len(order),) + np.shape(present[0])[1:]
+            if masked:
+                out = np.ma.array(np.empty(shape, dtype),
+                                  mask=np.ones(shape, dtype=bool))
+            else:
+                out = np.empty(shape, dtype)
+            for data, (dest, src) in zip(arrays, rows):
+                if data is not None:
+                    out[dest] = data[src]
+            return out
+
+        fields = {}
+        names = []
+        for dsd in dsds:
+            names.extend(name for name in dsd.fields if name not in names)
+        for name in names:
+            arrays = []
+            for dsd, numt in zip(dsds, np.diff(offsets)):
+                field = dsd.fields.get(name)
+                if name in dsd._derived_fields or \
+                        not isinstance(field, dict) or \
+                        np.ndim(field.get('data')) == 0 or \
+                        len(field['data']) != numt:
+                    arrays.append(None)
+                elif 'flag_meanings' in field:
+                    arrays.append(decode_categorical(field))
+                else:
+                    arrays.append(field['data'])
+            if all(data is None for data in arrays):
+                continue
+            template = next(dsd.fields[name] for dsd, data
+                            in zip(dsds, arrays) if data is not None)
+            fields[name] = dict(template)
+            fields[name]['data'] = merge(arrays)
+            if 'flag_meanings' in template:
+                fields[name]['data'] = np.ma.filled(fields[name]['data'], '')
+                categorical_to_dict(fields[name])
+
+        merged_time = dict(first.time)
+        merged_time['data'] = time[order]
+        dsd = cls(_Record(merged_time, fields, first))
+        if first.storage != 'masked':
+            dsd.set_storage(first.storage)
+        dsd.time_start = first.time_start
+        return dsd
+
+    @staticmethod
+    def _same_bins(dsd, other):
+        ''' Whether two records have the same size bins. '''
+        for name in ['bin_edges', 'diameter', 'spread']:
+            a, b = getattr(dsd, name), getattr(other, name)
+            if (a is None) != (b is None):
+                return False
+            if a is None:
+                continue
+            a = np.asarray(a['data'] if isinstance(a, dict) else a, float)
+            b = np.asarray(b['data'] if isinstance(b, dict) else b, float)
+            if a.shape != b.shape or not np.allclose(a, b):
+                return False
+        return True
+
+    def _like(self, time, fields, scattering_temp):
+        ''' DropSizeDistribution of other timesteps with the size bins,
+        storage and scattering setup of this one.
+        '''
+        dsd = DropSizeDistribution(_Record(time, fields, self))
+        if self.storage != 'masked':
+            dsd.set_storage(self.storage)
+        dsd.scattering_cache = self.scattering_cache
+        dsd.set_scattering_temperature_and_frequency(scattering_temp,
+                                                     self.scattering_freq)
+        dsd.m_w = self.m_w
+        for attr in SCATTERING_STATE:
+            setattr(dsd, attr, getattr(self, attr))
+        if hasattr(self, 'dsr_func'):
+            dsd.dsr_func = self.dsr_func
+        return dsd
+
+    def _adopt_scattering(self, dsd):
+        ''' Take over the scattering setup and statistics of a
+        DropSizeDistribution made by `_like`.
+        '''
+        for attr in SCATTERING_STATE:
+            setattr(self, attr, getattr(dsd, attr))
+        if hasattr(dsd, 'dsr_func'):
+            self.dsr_func = dsd.dsr_func
+        for key, count in dsd.scattering_stats.items():
+            self.scattering_stats[key] += count
+
+    @staticmethod
+    def _encode_categories(field, codes):
+        ''' Codes of the category names codes in a categorical field.
+
+        Categories that are new to the field are added to its flag_values
+        and flag_meanings, and empty names give masked codes. Fields that
+        hold strings get codes unchanged.
+        '''
+        if 'flag_meanings' not in field:
+            return codes
+        missing = codes == ''
+        lookup = dict(zip(field['flag_meanings'].split(),
+                          np.asarray(field['flag_values']).tolist()))
+        categories, inverse = np.unique(codes[~missing], return_inverse=True)
+        for category in categories:
+            if category not in lookup:
+                lookup[category] = max(lookup.values()) + 1 if lookup else 0
+        if lookup and max(lookup.values()) > 255:
+            raise ValueError("Too many categories for uint8 codes.")
+        names = sorted(lookup, key=lookup.get)
+        field['flag_values'] = np.array([lookup[name] for name in names],
+                                        dtype=np.uint8)
+        field['flag_meanings'] = ' '.join(names)
+        values = np.zeros(len(codes), dtype=np.uint8)
+        values[~missing] = np.array([lookup[category]
+                                     for category in categories],
+                                    dtype=np.uint8)[inverse.ravel()]
+        return np.ma.array(values, mask=missing)
+
+    def _append_rows(self, key, current, values):
+        ''' Append values to the per timestep array current.
+
+        current is extended in place when it is the last view returned for
+        key and its buffer has room left. Otherwise a buffer of twice the
+        needed size is allocated, so that appending is amortized O(1).
+
+        Parameters:
+        -----------
+        key: tuple
+            Name of the buffer.
+        current: array_like
+            Array with one row per timestep.
+        values: array_like
+            Rows to append.
+
+        Returns:
+        --------
+        data: array
+            View of the first len(current) + len(values) buffer rows.
+        '''
+        buffer, view = self._buffers.get(key, (None, None))
+        n_old = len(current)
+        n = n_old + len(values)
+        masked = np.ma.isMaskedArray(current) or np.ma.isMaskedArray(values)
+        dtype = np.promote_types(np.asarray(current).dtype,
+                                 np.asarray(values).dtype)
+        if view is not current or len(buffer) < n or \
+                buffer.dtype != dtype or \
+                masked != np.ma.isMaskedArray(buffer):
+            shape = (max(n, 2 * n_old),) + np.shape(values)[1:]
+            if masked:
+                buffer = np.ma.array(np.empty(shape, dtype),
+                                     mask=np.ones(shape, dtype=bool))
+            else:
+                buffer = np.empty(shape, dtype)
+            buffer[:n_old] = current
+        buffer[n_old:n] = values
+        view = buffer[:n]
+        if masked:
+            # Write masked values through to the buffer, so that they are
+            # kept when the view is extended again.
+            view._sharedmask = False
+        self._buffers[key] = (buffer, view)
+        return view
+
+    def set_chunking(self, size, directory=None):
+        ''' Process the record in chunks of size timesteps.
+
+        For records too long to process at once. calculate_* methods and
+        derived fields are then computed chunk by chunk and written into
+        preallocated output arrays, so that the memory used for temporary
+        arrays is bounded by the chunk size instead of the record length.
+        With a directory Nd and the calculated fields are kept in memory
+        mapped .npy files there, e.g. Nd.npy and D0.npy, and only the
+        chunk being processed needs to be in memory. Nd can also be set
+        to an array opened with np.load(..., mmap_mode='r') beforehand.
+        Memory mapped fields hold NaN for masked values, in the dtype of
+        the storage mode.
+
+        Parameters:
+        -----------
+        size: int
+            Number of timesteps per chunk, None to turn chunking off.
+        directory: optional, str
+            Directory for the memory mapped arrays, created if needed.
+            Existing files of the same names are overwritten.
+        '''
+        self.chunk_size = size
+        self.chunk_directory = directory
+        if directory is None or size is None:
+            return
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        Nd = self.Nd['data']
+        if isinstance(Nd, np.memmap):
+            return
+        dtype = np.float32 if self.storage == 'compact' else float
+        out = np.lib.format.open_memmap(os.path.join(directory, 'Nd.npy'),
+                                        mode='w+', dtype=dtype,
+                                        shape=np.shape(Nd))
+        for start in range(0, len(out), size):
+            out[start:start + size] = np.ma.filled(Nd[start:start + size], 0)
+        out.flush()
+        self._drop_stale_fields()
+        self.Nd['data'] = out
+        self._fields_Nd = out
+
+    def iter_chunks(self, size=None):
+        ''' Iterate over the record in chunks of timesteps.
+
+        Parameters:
+        -----------
+        size: optional, int
+            Number of timesteps per chunk, defaults to `chunk_size`.
+
+        Yields:
+        -------
+        chunk: `DropSizeDistribution`
+            The next size timesteps, with the per timestep fields sliced
+            from this record without copying. Chunks share the scattering
+            tables of this record, and derived fields calculated on them
+            are not stored back.
+        '''
+        size = size or self.chunk_size
+        if size is None:
+            raise ValueError("No chunk size given.")
+        for start in range(0, self.numt, size):
+            yield self._chunk(slice(start, min(start + size, self.numt)))
+
+    def _chunk(self, rows):
+        ''' DropSizeDistribution of the timesteps in the slice rows. '''
+        self._drop_stale_fields()
+        fields = {}
+        for name, field in self.fields.items():
+            data = field.get('data') if isinstance(field, dict) else None
+            if np.ndim(data) > 0 and len(data) == self.numt:
+                field = dict(field)
+                field['data'] = data[rows]
+            fields[name] = field
+        time = dict(self.time)
+        time['data'] = self.time['data'][rows]
+        temperature = self.scattering_temp
+        if np.ndim(temperature) > 0:
+            temperature = temperature[rows]
+        return self._like(time, fields, temperature)
+
+    def _calculate_chunked(self, calculate):
+        ''' Call calculate(chunk, rows) on every chunk of the record and
+        gather the fields it calculates into arrays for the whole record.
+        '''
+        outputs = {}
+        for start in range(0, self.numt, self.chunk_size):
+            rows = slice(start, min(start + self.chunk_size, self.numt))
+            chunk = self._chunk(rows)
+            calculate(chunk, rows)
+            for name in chunk._derived_fields:
+                field = chunk.fields[name]
+                if name not in outputs:
+                    outputs[name] = dict(field)
+                    outputs[name]['data'] = self._chunk_output(
+                        name, field['data'])
+                out = outputs[name]['data']
+                if np.ma.isMaskedArray(out):
+                    out[rows] = field['data']
+                else:
+                    out[rows] = np.ma.filled(field['data'], np.nan)
+            self._adopt_scattering(chunk)
+        for name, field in outputs.items():
+            if isinstance(field['data'], np.memmap):
+                field['data'].flush()
+            self.fields[name] = field
+            self._derived_fields.add(name)
+
+    def _chunk_output(self, name, data):
+        ''' Preallocate the record wide array of a field calculated in
+        chunks, memory mapped in chunk_directory when it is set.
+        '''
+        shape = (self.numt,) + np.shape(data)[1:]
+        dtype = np.asarray(data).dtype
+        if self.chunk_directory is not None:
+            return np.lib.format.open_memmap(
+                os.path.join(self.chunk_directory, name + '.npy'),
+                mode='w+', dtype=dtype, shape=shape)
+        if np.ma.isMaskedArray(data):
+            return np.ma.array(np.empty(shape, dtype),
+                               mask=np.zeros(shape, dtype=bool))
+        return np.empty(shape, dtype)
+
+    def _nonempty(self):
+        ''' Indices of the timesteps with a non-empty spectrum. '''
+        return np.nonzero(np.ma.filled(np.ma.sum(self.Nd['data'], axis=1),
+                                       0) != 0)[0]
+
+    def _calculate_Dmax_batch(self):
+        ''' Diameter of the last non-zero bin of each spectrum, or 0. '''
+        nonzero = np.ma.filled(self.Nd['data'], 0) != 0
+        last = nonzero.shape[1] - 1 - np.argmax(nonzero[:, ::-1], axis=1)
+        Dmax = np.zeros(self.numt)
+        rows = self._nonempty()
+        Dmax[rows] = np.asarray(self.diameter['data'])[last[rows]]
+        return Dmax
 
     def _calculate_D0(self, N):
         ''' Calculate Median Drop diameter.
@@ -403,42 +1467,99 @@ class DropSizeDistribution(object):
         water content goes over 0.5, and then interpolates
         the correct D0 value between these two bins.
         '''
+        return self._calculate_D0_batch(np.ma.atleast_2d(N))[0]
 
-        rho_w = 1e-3
-        W_const = rho_w * np.pi / 6.0
+    def _calculate_D0_batch(self, Nd, chunk_size=65536):
+        ''' Calculate Median Drop diameter for many spectra.
 
-        if np.sum(N) == 0:
-            return 0
+        Vectorized version of `_calculate_D0`, giving the same results.
+        Empty spectra get a D0 of 0. When the first bin already holds half
+        of the water content the interpolation is done between the last
+        and the first bin, as `_calculate_D0` always did.
 
-        cum_W = W_const * np.cumsum([N[k] * self.spread['data'][k] *
-                                    (self.diameter['data'][k] ** 3)
-                                    for k in range(0, len(N))])
-        cross_pt = list(cum_W < (cum_W[-1] * 0.5)).index(False) - 1
-        slope = (cum_W[cross_pt + 1] - cum_W[cross_pt]) / \
-            (self.diameter['data'][cross_pt + 1] -
-             self.diameter['data'][cross_pt])
-        run = (0.5 * cum_W[-1] - cum_W[cross_pt]) / slope
-        return self.diameter['data'][cross_pt] + run
+        Parameters:
+        -----------
+        Nd: 2d array
+            Drop counts, one row per spectrum and one column per size bin.
+        chunk_size: optional, int
+            Number of spectra processed at once, bounding memory use.
 
-    def calculate_RR(self, cut=30):
+        Returns:
+        --------
+        D0: array
+            Median drop diameter of each spectrum.
+        '''
+        rho_w = 1e-3
+        W_const = rho_w * np.pi / 6.0
+        D = np.asarray(self.diameter['data'], dtype=float)
+        spread = np.asarray(self.spread['data'], dtype=float)
+        # Cubed elementwise, numpy's vectorized power rounds differently.
+        D3 = np.array([d ** 3 for d in D])
+
+        D0 = np.zeros(len(Nd))
+        for start in range(0, len(Nd), chunk_size):
+            N = np.ma.filled(Nd[start:start + chunk_size], 0)
+            rows = np.nonzero(np.sum(N, axis=1) != 0)[0]
+            cum_W = W_const * np.cumsum(N[rows] * spread * D3, axis=1)
+            half = 0.5 * cum_W[:, -1]
+            # Last bin below half of the water content, -1 if there is none.
+            cross_pt = np.argmin(cum_W < half[:, np.newaxis], axis=1) - 1
+            lower = cum_W[np.arange(len(rows)), cross_pt]
+            upper = cum_W[np.arange(len(rows)), cross_pt + 1]
+            slope = (upper - lower) / (D[cross_pt + 1] - D[cross_pt])
+            run = (half - lower) / slope
+            D0[start + rows] = D[cross_pt] + run
+        return D0
+
+    @_chunked
+    def calculate_RR(self, cut=30, velocity='atlas'):
         '''Calculate instantaneous rain rate.
 
         This calculates instantaneous rain rate based on the flux of water.
+        All timesteps are computed with one product of Nd and precomputed
+        per bin weights.
+
+        Parameters:
+        -----------
+        cut: optional, float
+            Drops from the bin nearest to this diameter [mm] upwards are
+            left out.
+        velocity: optional, str or array_like
+            Terminal fall velocity [m/s] of each bin. 'atlas' uses the
+            Atlas et al. (1973) fit, 'measured' the terminal_velocity field
+            of the instrument, with the Atlas fit in bins that have no
+            measurement. An array gives the velocity of each bin, either
+            for all timesteps (nbins,) or per timestep (numt, nbins).
         '''
-        idx = self._find_nearest(self.diameter['data'], cut)
-        self.fields['RR'] = {'data': np.ma.zeros(self.numt)}
-        for t in range(0, self.numt):
-            # self.rain_rate['data'][t] = 0.6*3.1415 * 10**(-3) * \
-            #    np.dot(np.multiply(self.rain_rate['data'],
-            #           np.multiply(self.Nd['data'][t],self.spread['data'] )),
-            #    np.array(self.diameter['data'])**3)
-            velocity = 9.65 - 10.3 * np.exp(-0.6 * self.diameter['data'])
-            velocity[0] = 0.5
-            d3 = np.zeros(len(self.diameter['data']))
-            d3[0:idx] = np.array(self.diameter['data'][0:idx] ** 3)
-            self.fields['RR']['data'][t] = 0.6 * np.pi * 1e-03 * \
-                np.sum(self._mmultiply(velocity, self.Nd['data'][t],
-                                       self.spread['data'], d3))
+        self._rr_kwargs = {'cut': cut, 'velocity': velocity}
+        D = np.asarray(self.diameter['data'], dtype=float)
+        idx = self._find_nearest(D, cut)
+        d3 = np.zeros(len(D))
+        d3[0:idx] = D[0:idx] ** 3
+        atlas = 9.65 - 10.3 * np.exp(-0.6 * D)
+        atlas[0] = 0.5
+
+        if isinstance(velocity, str):
+            if velocity == 'atlas':
+                velocity = atlas
+            elif velocity == 'measured':
+                if self.velocity is None:
+                    raise ValueError("No terminal_velocity field to use.")
+                measured = np.ma.filled(
+                    np.ma.asarray(self.velocity['data'], dtype=float), 0)
+                velocity = np.where(measured > 0, measured, atlas)
+            else:
+                raise ValueError("Unknown velocity: %s" % velocity)
+        velocity = np.asarray(velocity, dtype=float)
+
+        weights = 0.6 * np.pi * 1e-03 * velocity * \
+            np.asarray(self.spread['data'], dtype=float) * d3
+        Nd = np.ma.filled(self.Nd['data'], 0)
+        if weights.ndim == 1:
+            rain_rate = np.dot(Nd, weights)
+        else:
+            rain_rate = np.einsum('ij,ij->i', Nd, weights)
+        self._store_field('RR', rain_rate)
 
     def calculate_R_Kdp_relationship(self):
         '''
@@ -447,19 +1568,15 @@ class DropSizeDistribution(object):
         parameters(which should have already been run). It returns
         the scale and exponential parameter a and b in the first tuple,
         and the second returned argument gives the covariance matrix of
-        the fit.
+        the fit. Kdp and RR are calculated if they are missing.
         '''
 
-        if 'RR' in list(self.fields.keys()):
-            filt = np.logical_and(
-                self.fields['Kdp']['data'] > 0, self.fields['RR']['data'] > 0)
-            popt, pcov = expfit(self.fields['Kdp']['data'][filt],
-                                self.fields['RR']['data'][filt])
+        filt = np.logical_and(
+            self.fields['Kdp']['data'] > 0, self.fields['RR']['data'] > 0)
+        popt, pcov = expfit(self.fields['Kdp']['data'][filt],
+                            self.fields['RR']['data'][filt])
 
-            return popt, pcov
-        else:
-            print("Please run calculate_RR() function first.")
-            return None
+        return popt, pcov
 
     def calculate_R_Zh_relationship(self):
         '''
@@ -596,6 +1713,102 @@ class DropSizeDistribution(object):
         else:
             return res.x
 
+    def _estimate_mu_batch(self, bounds=(-10, 20), num_grid=61, tol=1e-5,
+                           chunk_size=65536):
+        """ Estimate $\mu$ for all drop size distributions at once.
+
+        Batched version of `_estimate_mu`, minimizing the same cost for all
+        timesteps together. The cost is first evaluated on a coarse grid
+        of $\mu$ over bounds, then the bracket around the best grid point
+        is refined by a vectorized golden-section search. Unlike the local
+        search of `_estimate_mu` this finds the global minimum over the
+        grid, ignoring mu <= -3.67 where the normalized gamma distribution
+        is not defined. D0 and Nw must have been calculated.
+
+        Parameters
+        ----------
+        bounds : optional, tuple
+            Search interval for $\mu$.
+        num_grid : optional, int
+            Number of points of the coarse grid.
+        tol : optional, float
+            Width of the final bracket around $\mu$.
+        chunk_size : optional, int
+            Number of spectra processed at once, bounding memory use.
+
+        Returns
+        -------
+        mu : array
+            Best estimate of $\mu$ for each timestep, NaN for empty
+            distributions.
+        """
+        Nd = np.ma.filled(self.Nd['data'], np.nan).astype(float)
+        D0 = np.ma.filled(self.fields['D0']['data'], np.nan).astype(float)
+        Nw = np.ma.filled(self.fields['Nw']['data'], np.nan).astype(float)
+        grid = np.linspace(bounds[0], bounds[1], num_grid)
+        invphi = (np.sqrt(5.0) - 1) / 2
+        n_iter = int(np.ceil(np.log(tol / (2 * (grid[1] - grid[0]))) /
+                             np.log(invphi)))
+
+        mu = np.full(len(Nd), np.nan)
+        for start in range(0, len(Nd), chunk_size):
+            rows = start + np.nonzero(
+                np.nansum(Nd[start:start + chunk_size], axis=1) != 0)[0]
+            if len(rows) == 0:
+                continue
+            args = (Nd[rows], D0[rows], Nw[rows])
+            costs = np.column_stack([
+                self._mu_cost_batch(np.full(len(rows), x), *args)
+                for x in grid])
+            best = np.argmin(costs, axis=1)
+            a = grid[np.maximum(best - 1, 0)]
+            b = grid[np.minimum(best + 1, num_grid - 1)]
+            c = b - invphi * (b - a)
+            d = a + invphi * (b - a)
+            fc = self._mu_cost_batch(c, *args)
+            fd = self._mu_cost_batch(d, *args)
+            for i in range(n_iter):
+                # Keep [a, d] where c is lower, else [c, b], and evaluate
+                # the one new interior point.
+                left = fc < fd
+                b = np.where(left, d, b)
+                a = np.where(left, a, c)
+                x = np.where(left, b - invphi * (b - a),
+                             a + invphi * (b - a))
+                fx = self._mu_cost_batch(x, *args)
+                c, d = np.where(left, x, d), np.where(left, c, x)
+                fc, fd = np.where(left, fx, fd), np.where(left, fc, fx)
+            mu[rows] = (a + b) / 2
+        return mu
+
+    def _mu_cost_batch(self, mu, Nd, D0, Nw):
+        """ Vectorized `_mu_cost` for one $\mu$ per distribution.
+
+        Parameters
+        ----------
+        mu : array_like
+            Potential $\mu$ value for each distribution.
+        Nd : 2d array
+            Drop size distributions.
+        D0 : array_like
+            Median drop diameter of each distribution.
+        Nw : array_like
+            Normalized intercept parameter of each distribution.
+
+        Returns
+        -------
+        cost : array
+            Cost of each distribution, inf where the normalized gamma
+            distribution is not defined (mu <= -3.67).
+        """
+        mu = np.asarray(mu, dtype=float)
+        psd = normalized_gamma(self.diameter['data'], D0, Nw, mu)
+        with np.errstate(all='ignore'):
+            cost = np.sqrt(np.nansum(np.abs(Nd - psd) ** 2, axis=1))
+        # The normalized gamma distribution needs mu > -3.67.
+        cost[~(mu > -3.67) | np.isnan(cost)] = np.inf
+        return cost
+
     def _mu_cost(self, mu, idx):
         """ Cost function for goodness of fit of a distribution.
 
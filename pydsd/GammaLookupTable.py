@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+'''
+The GammaLookupTable module contains the GammaLookupTable class, a table of
+polarimetric radar variables precomputed with `DSDProcessor` on a grid of
+normalized gamma DSD parameters. It is intended for forward operators that
+need radar variables for many (D0, Nw, mu) triples, where calling the
+T-matrix code for every point would be too slow.
+'''
+
+import numpy as np
+from netCDF4 import Dataset
+from pytmatrix import tmatrix_aux
+
+from .DSDProcessor import DSDProcessor
+from .DropSizeDistribution import SPEED_OF_LIGHT
+from .utility import dielectric
+
+MOMENTS = ['Zh', 'Zdr', 'delta_hv', 'ldr_h', 'ldr_v', 'Kdp', 'Ah', 'Adr']
+
+# Variables proportional to Nw. They are tabulated per unit Nw so that
+# interpolation along the log10(Nw) axis is exact.
+PROPORTIONAL_TO_NW = ['Kdp', 'Ah', 'Adr']
+
+
+class GammaLookupTable(object):
+
+    '''
+    GammaLookupTable class holding radar variables tabulated on a regular
+    (D0, log10(Nw), mu) grid.
+
+    Attributes
+    ----------
+        D0: array_like
+            Grid of median volume diameters [mm].
+        log10_Nw: array_like
+            Grid of log10 of the normalized intercept parameter.
+        mu: array_like
+            Grid of shape parameters.
+        moments: dict
+            Radar variables of shape (len(D0), len(log10_Nw), len(mu)),
+            keyed as in `DSDProcessor.calcParameters`.
+        info: dict
+            Description of the scattering setup of the table.
+    '''
+
+    def __init__(self, D0, log10_Nw, mu, moments, info=None):
+        self.D0 = np.asarray(D0, dtype=float)
+        self.log10_Nw = np.asarray(log10_Nw, dtype=float)
+        self.mu = np.asarray(mu, dtype=float)
+        self.moments = moments
+        self.info = info or {}
+        self._values = None
+
+    @classmethod
+    def from_processor(cls, processor, D0=np.arange(0.5, 3.51, 0.05),
+                       log10_Nw=np.arange(1.0, 6.01, 0.25),
+                       mu=np.arange(-2.0, 15.01, 0.5), n_workers=None):
+        ''' Compute a lookup table with a `DSDProcessor`.
+
+        Parameters
+        ----------
+        processor: `DSDProcessor`
+            Processor set up for the band, temperature and DSR wanted.
+        D0: optional, array_like
+            Grid of median volume diameters [mm].
+        log10_Nw: optional, array_like
+            Grid of log10 of the normalized intercept parameter.
+        mu: optional, array_like
+            Grid of shape parameters.
+        n_workers: optional, int
+            Number of processes used to compute the table.
+
+        Returns
+        -------
+        table: `GammaLookupTable`
+            The computed lookup table.
+        '''
+        grid = np.meshgrid(D0, log10_Nw, mu, indexing='ij')
+        moments = processor.calcParametersBatch(*grid, n_workers=n_workers)
+        scatterer = processor.scatterer
+        info = {'wavelength': scatterer.wavelength,
+                'm_real': np.real(scatterer.m),
+                'm_imag': np.imag(scatterer.m),
+                'dsr': processor.setup[2].__name__}
+        return cls(D0, log10_Nw, mu, moments, info)
+
+    @classmethod
+    def build(cls, wl=tmatrix_aux.wl_X, temperature=None, shape='bc', n_workers=None,
+              cache=None, **grid):
+        ''' Set up a `DSDProcessor` and compute a lookup table with it.
+
+        Parameters
+        ----------
+        wl: optional, float
+            Wavelength [mm], defaults to X band.
+        temperature: optional, float
+            Water temperature [C] used for the refractive index. Defaults to
+            the 10C pytmatrix value.
+        shape: optional, str
+            Drop shape relationship, 'bc', 'tb' or 'pb'.
+        n_workers: optional, int
+            Number of processes used to compute the table.
+        cache: optional, `ScatteringTableCache`
+            On disk cache of scattering tables.
+        **grid:
+            D0, log10_Nw and mu grids passed to `from_processor`.
+        '''
+        m = None
+        if temperature is not None:
+            m = dielectric.get_refractivity(SPEED_OF_LIGHT / wl * 1000.0,
+                                            temperature)
+        processor = DSDProcessor(wl=wl, shape=shape, cache=cache, m=m)
+        table = cls.from_processor(processor, n_workers=n_workers, **grid)
+        if temperature is not None:
+            table.info['temperature'] = temperature
+        return table
+
+    def __call__(self, D0, log10_Nw, mu, variables=None):
+        ''' Interpolate radar variables for arrays of gamma parameters.
+
+        Parameters
+        ----------
+        D0: array_like
+            Median volume diameters [mm].
+        log10_Nw: array_like
+            log10 of the normalized intercept parameters.
+        mu: array_like
+            Shape parameters.
+        variables: optional, list of str
+            Variables to return, defaults to all.
+
+        Returns
+        -------
+        moments: dict
+            Multilinearly interpolated variables with the broadcast shape
+            of the inputs. Points outside the table are NaN.
+        '''
+        if self._values is None:
+            self._values = self._interpolation_values()
+        D0, log10_Nw, mu = np.broadcast_arrays(
+            np.asarray(D0, dtype=float), np.asarray(log10_Nw, dtype=float),
+            np.asarray(mu, dtype=float))
+        shape = D0.shape
+        log10_Nw = log10_Nw.ravel()
+
+        if variables is None:
+            keys = MOMENTS
+        else:
+            keys = [key for key in MOMENTS if key in variables]
+        table = self._values[:, [MOMENTS.index(key) for key in keys]]
+
+        # Multilinear interpolation: locate each point in its grid cell and
+        # sum the 8 cell corners with their weights.
+        grids = (self.D0, self.log10_Nw, self.mu)
+        strides = (len(self.log10_Nw) * len(self.mu), len(self.mu), 1)
+        base = 0
+        weight = []
+        outside = np.zeros(D0.size, dtype=bool)
+        for grid, stride, x in zip(grids, strides,
+                                   (D0.ravel(), log10_Nw, mu.ravel())):
+            i = np.clip(np.searchsorted(grid, x) - 1, 0, len(grid) - 2)
+            base = base + i * stride
+            weight.append((x - grid[i]) / (grid[i + 1] - grid[i]))
+            outside |= ~((x >= grid[0]) & (x <= grid[-1]))
+
+        values = 0.0
+        for corner in range(8):
+            offset = [(corner >> axis) & 1 for axis in range(3)]
+            w = 1.0
+            for axis in range(3):
+                w = w * (weight[axis] if offset[axis] else
+                         1.0 - weight[axis])
+            shift = sum(o * stride for o, stride in zip(offset, strides))
+            values = values + w[:, np.newaxis] * np.take(table, base + shift,
+                                                         axis=0)
+        values[outside] = np.nan
+
+        moments = {}
+        for i, key in enumerate(keys):
+            value = values[:, i]
+            if key in PROPORTIONAL_TO_NW:
+                value = value * 10 ** log10_Nw
+            moments[key] = value.reshape(shape)
+        return moments
+
+    query = __call__
+
+    def _interpolation_values(self):
+        Nw = 10 ** self.log10_Nw[np.newaxis, :, np.newaxis]
+        values = []
+        for key in MOMENTS:
+            value = np.asarray(self.moments[key], dtype=float)
+            if key in PROPORTIONAL_TO_NW:
+                value = value / Nw
+            values.append(value)
+        return np.stack(values, axis=-1).reshape(-1, len(MOMENTS))
+
+    def save(self, filename):
+        ''' Save the table to a netCDF (.nc) or numpy (.npz) file. '''
+        if filename.endswith('.nc'):
+            with Dataset(filename, 'w') as nc:
+                for name in ['D0', 'log10_Nw', 'mu']:
+                    nc.createDimension(name, len(getattr(self, name)))
+                    nc.createVariable(name, 'f8', (name,))[:] = \
+                        getattr(self, name)
+                for key in MOMENTS:
+                    nc.createVariable(key, 'f8', ('D0', 'log10_Nw', 'mu'))[:] \
+                        = self.moments[key]
+                nc.setncatts(self.info)
+        else:
+            # Info entries are stored as plain arrays, so that loading does
+            # not need to unpickle objects.
+            info = dict(('info_' + key, np.asarray(value))
+                        for key, value in self.info.items())
+            if any(value.dtype.kind == 'O' for value in info.values()):
+                raise ValueError("Table info values must be numbers or "
+                                 "strings.")
+            np.savez(filename, D0=self.D0, log10_Nw=self.log10_Nw,
+                     mu=self.mu, **dict(self.moments, **info))
+
+    @classmethod
+    def load(cls, filename):
+        ''' Load a table saved with `save`. '''
+        if filename.endswith('.nc'):
+            with Dataset(filename) as nc:
+                grid = [nc.variables[name][:].filled(np.nan)
+                        for name in ['D0', 'log10_Nw', 'mu']]
+                moments = dict((key, nc.variables[key][:].filled(np.nan))
+                               for key in MOMENTS)
+                info = dict((key, nc.getncattr(key))
+                            for key in nc.ncattrs())
+        else:
+            with np.load(filename, allow_pickle=False) as data:
+                grid = [data[name] for name in ['D0', 'log10_Nw', 'mu']]
+                moments = dict((key, data[key]) for key in MOMENTS)
+                info = dict((name[len('info_'):], data[name].item())
+                            for name in data.files
+                            if name.startswith('info_'))
+        return cls(grid[0], grid[1], grid[2], moments, info)
@@ -1,6 +1,7 @@
-from .io.ParsivelReader import read_parsivel
+from .io.ParsivelReader import read_parsivel, iter_parsivel
 from .io.ParsivelNasaGVReader import read_parsivel_nasa_gv
 from .io.JWDReader import read_jwd
+from .io.MultiFileReader import read_many
 from .io.Image2DReader import read_ucsc_netcdf, read_noaa_aoml_netcdf
 from .io import csv_writer
 
@@ -2,6 +2,7 @@
 import numpy as np
 import csv
 import datetime
+import os
 
 from ..DropSizeDistribution import DropSizeDistribution
 from ..io import common
@@ -40,6 +41,7 @@ class GPMApuWallopsRawReader(object):
         '''
         Handles setting up a NASA APU Reader for Raw 1024 Size Data
         '''
+        self.filename = filename
         self.fields = {}
         time = []  # Time in minutes from start of recording
         self.raw = []
@@ -55,24 +57,30 @@ class GPMApuWallopsRawReader(object):
             self.num_drops.append(float(row[3]))
             self.rr.append(float(row[4]))
 
-        time = np.ma.array(self.time)
+        time = np.ma.array(time)
         # NEED TO GRAB DATE FROM FILE
         yyyy = os.path.basename(self.filename).split(".")[1][0:4]
         mm = os.path.basename(self.filename).split(".")[1][4:6]
         dd = os.path.basename(self.filename).split(".")[1][6:8]
         t_units = 'minutes since ' + "-".join([yyyy, mm, dd]) + 'T00:00:00'
         # Return a common epoch time dictionary
-        self.time = _get_epoch_time(time, t_units)
+        self.time = common.get_epoch_time(time, t_units)
 
         self.Md = np.reshape(self.raw, (-1, 32, 32))
         self.bin_edges = common.var_to_dict(
             'bin_edges',
             np.hstack(
-                (0, self.diameter + np.array(self.spread) / 2)),
+                (0, self.diameter['data'] + self.spread['data'] / 2)),
             'mm', 'Boundaries of bin sizes')
-        Nd = conv_md_nd(Md)
+        # The counts are divided by the fall velocity of their diameter
+        # class rather than of their velocity class.
+        velocity = np.broadcast_to(self.velocity['data'], self.Md.shape[1:])
+        Nd = common.raw_matrix_to_nd(
+            self.Md, self.diameter['data'], self.spread['data'], velocity,
+            interval=self.sample_interval)
         self.fields['Nd'] = common.var_to_dict(
-            'Nd', Nd, 'm^-3', 'Liquid water particle concentration')
+            'Nd', np.ma.array(Nd), 'm^-3',
+            'Liquid water particle concentration')
 
         self.f.close()
 
@@ -91,31 +99,6 @@ class GPMApuWallopsRawReader(object):
         return float(time_vector[8:10]) * 60.0 +\
             float(time_vector[10:12]) + float(time_vector[12:14])/60.0
 
-    def conv_md_to_nd(self, Md, t=10/60.0):
-        F = 0.0054
-        #v = 9.65 - 10.3 * np.exp(-0.6 * self.diameter)
-        vel_mat = np.tile(self.velocity, (32, 1))
-        spread_mat = np.tile(np.ma.array(self.spread).T, (32, 1))
-        self.Nd_mat = np.ma.zeros(np.shape(Md))
-        Nd_array = np.ma.zeros((len(self.time), 32))
-        for ti in range(0, len(self.time)):
-            Nd_mat[ti] = np.divide(
-                Md[ti], (F * 60*t * np.multiply(vel_mat, spread_mat)))
-            Nd_array[ti] = np.sum(self.Nd_mat[ti], axis=0)
-        return Nd_array
-
-    def _get_epoch_time(sample_times, t_units):
-        """Convert time to epoch time and return a dictionary."""
-        # Convert the time array into a datetime instance
-        dts = num2date(sample_times, t_units)
-        # Now convert this datetime instance into a number of seconds since Epoch
-        timesec = date2num(dts, common.EPOCH_UNITS)
-        # Now once again convert this data into a datetime instance
-        time_unaware = num2date(timesec, common.EPOCH_UNITS)
-        eptime = {'data': time_unaware, 'units': common.EPOCH_UNITS,
-                  'standard_name': 'Time', 'long_name': 'Time (UTC)'}
-
-
     spread = common.var_to_dict(
         'spread',
         np.array([
@@ -141,4 +124,6 @@ class GPMApuWallopsRawReader(object):
              6.00, 6.80, 7.60, 8.80, 10.40, 12.00, 13.60, 15.20, 17.60, 20.80]),
         'm s^-1', 'Terminal fall velocity for each bin')
 
+    sample_interval = 10.0  # seconds
+
     supported_campaigns = ['ifloods', 'mc3e_dsd', 'mc3e_raw']
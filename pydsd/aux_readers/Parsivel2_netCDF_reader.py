@@ -90,7 +90,8 @@ class Parsivel2_netCDF(object):
                           self.fields['terminal_velocity']['_FillValue'])
         del self.fields['terminal_velocity']['_FillValue']
 
-        self.fields['Precip_Code'] = common.ncvar_to_dict(self.nc_dataset.variables['PrecipCode'])
+        self.fields['Precip_Code'] = common.categorical_to_dict(
+            common.ncvar_to_dict(self.nc_dataset.variables['PrecipCode']))
 
         diameter = ma.array([0.0625, 0.1875, 0.3125, 0.4375, 0.5625, 0.6875, 0.8125, 0.9375, 1.0625,
                              1.1875, 1.375, 1.625, 1.875, 2.125, 2.375, 2.75, 3.25, 3.75, 4.25,
@@ -0,0 +1,486 @@
+# -*- coding: utf-8 -*-
+'''
+Batched fits of particle size distribution models. All estimators work on
+every spectrum of a record at once, so that millions of spectra are fitted
+in seconds, and return arrays of parameters with goodness of fit measures.
+
+Models, with D in mm and N(D) in m^-3 mm^-1:
+
+    'gamma':        N(D) = N0 * D^mu * exp(-Lambda*D)
+    'exponential':  N(D) = N0 * exp(-Lambda*D)
+    'lognormal':    N(D) = Nt / (sqrt(2 pi) sigma D) *
+                           exp(-(ln(D) - mu)^2 / (2 sigma^2))
+
+Methods:
+
+    'mom234', 'mom246', 'mom346': method of moments with the moment orders
+        given by the digits. The exponential model takes two orders, e.g.
+        'mom34', and the lognormal model any three.
+    'tmom234', ...: method of moments corrected for the truncation of the
+        distribution to the size range of the instrument. Iterative.
+    'ml': maximum likelihood of the drop counts over the size bins.
+        Iterative.
+    'lsq': least squares fit of log(N(D)) over the non-empty bins.
+'''
+
+from __future__ import division
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.special import gammainc, gammaln, ndtr
+
+MODELS = {
+    'gamma': ('N0', 'mu', 'Lambda'),
+    'exponential': ('N0', 'Lambda'),
+    'lognormal': ('Nt', 'mu', 'sigma'),
+}
+
+# Moment orders with a closed form method of moments for the gamma model.
+GAMMA_MOMENT_ORDERS = [(2, 3, 4), (2, 4, 6), (3, 4, 6)]
+
+
+def model_psd(model, D, params):
+    ''' Evaluate a size distribution model for many parameter sets.
+
+    Parameters
+    ----------
+    model: str
+        'gamma', 'exponential' or 'lognormal'.
+    D: array_like
+        Diameters [mm], shape (nD,).
+    params: dict
+        Parameter arrays of shape (n,), named as in MODELS.
+
+    Returns
+    -------
+    psd: array
+        Distribution values of shape (n, nD).
+    '''
+    D = np.asarray(D, dtype=float)
+    p = dict((name, np.atleast_1d(np.asarray(params[name], dtype=float))
+              [:, np.newaxis]) for name in MODELS[model])
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        if model == 'gamma':
+            return p['N0'] * np.exp(p['mu'] * np.log(D) - p['Lambda'] * D)
+        if model == 'exponential':
+            return p['N0'] * np.exp(-p['Lambda'] * D)
+        return p['Nt'] / (np.sqrt(2 * np.pi) * p['sigma'] * D) * \
+            np.exp(-(np.log(D) - p['mu']) ** 2 / (2 * p['sigma'] ** 2))
+
+
+def fit_dsd(dsd, model='gamma', method='mom246', n_workers=None, **kwargs):
+    ''' Fit a size distribution model to every timestep of a
+    DropSizeDistribution.
+
+    The method of moments estimators use the cached moments of the record,
+    see `DropSizeDistribution.calculate_moments`, and the instrument size
+    range is taken from its bin edges.
+
+    Parameters
+    ----------
+    dsd: `DropSizeDistribution`
+        Record to fit.
+    model: optional, str
+        Model to fit, see MODELS.
+    method: optional, str
+        Estimator, see the module documentation.
+    n_workers: optional, int
+        Number of processes for the iterative estimators.
+    **kwargs:
+        Passed on to `fit_spectra`.
+
+    Returns
+    -------
+    fit: dict
+        See `fit_spectra`.
+    '''
+    orders = _moment_orders(method)
+    moments = None
+    if orders:
+        moments = dict(zip(orders, dsd.calculate_moments(orders).T))
+    bin_edges = np.asarray(dsd.bin_edges['data'], dtype=float)
+    return fit_spectra(dsd.Nd['data'], dsd.diameter['data'],
+                       dsd._bin_width(), model, method, moments=moments,
+                       D_range=(bin_edges[0], bin_edges[-1]),
+                       n_workers=n_workers, **kwargs)
+
+
+def fit_spectra(Nd, D, dD, model='gamma', method='mom246', moments=None,
+                D_range=None, n_workers=None, max_iter=50, tol=1e-6):
+    ''' Fit a size distribution model to many spectra at once.
+
+    Parameters
+    ----------
+    Nd: array_like
+        Drop size distributions [m^-3 mm^-1], shape (n, nD).
+    D: array_like
+        Bin center diameters [mm], shape (nD,).
+    dD: array_like
+        Bin widths [mm], shape (nD,).
+    model: optional, str
+        Model to fit, see MODELS.
+    method: optional, str
+        Estimator, see the module documentation.
+    moments: optional, dict
+        Precomputed moments of Nd keyed by order, e.g. from
+        `DropSizeDistribution.calculate_moments`. Computed when missing.
+    D_range: optional, tuple
+        Size range (D_min, D_max) [mm] of the instrument used by the
+        truncated moments. Defaults to the outer edges of the bins.
+    n_workers: optional, int
+        Number of processes the iterative estimators ('tmom*' and 'ml')
+        split the spectra over. Runs in this process by default.
+    max_iter: optional, int
+        Maximum number of iterations of the iterative estimators.
+    tol: optional, float
+        Convergence tolerance of the iterative estimators.
+
+    Returns
+    -------
+    fit: dict
+        Parameter arrays named as in MODELS, NaN for spectra that could
+        not be fitted, and:
+        'rmse': root mean square difference of log10(N(D)) between data
+            and fit over the non-empty bins.
+        'ks': largest difference between the cumulative number fractions
+            of data and fit (Kolmogorov-Smirnov distance).
+        'converged': False for spectra where an iterative estimator did
+            not converge.
+    '''
+    if model not in MODELS:
+        raise ValueError("Unknown model: %s" % model)
+    Nd = np.ma.filled(np.ma.asarray(Nd, dtype=float), 0)
+    D = np.asarray(D, dtype=float)
+    dD = np.asarray(dD, dtype=float)
+    if D_range is None:
+        D_range = (D[0] - dD[0] / 2, D[-1] + dD[-1] / 2)
+
+    orders = _moment_orders(method)
+    if orders:
+        moments = dict(moments or {})
+        missing = [m for m in orders if m not in moments]
+        if missing:
+            weights = np.power.outer(D, np.asarray(missing, dtype=float)) * \
+                dD[:, np.newaxis]
+            for m, values in zip(missing, np.dot(Nd, weights).T):
+                moments[m] = values
+        moments = np.column_stack([np.asarray(moments[m], dtype=float)
+                                   for m in orders])
+
+    if not orders and method not in ('ml', 'lsq'):
+        raise ValueError("Unknown method: %s" % method)
+    args = (Nd, D, dD, model, method, orders, moments, D_range, max_iter,
+            tol)
+    iterative = method == 'ml' or method.startswith('tmom')
+    if iterative and n_workers and len(Nd) > 1:
+        params, converged = _fit_parallel(args, n_workers)
+    else:
+        params, converged = _fit(*args)
+
+    fit = dict(params)
+    fit['converged'] = converged
+    fit.update(goodness_of_fit(Nd, D, dD, model, params))
+    return fit
+
+
+def goodness_of_fit(Nd, D, dD, model, params):
+    ''' Goodness of fit of model parameters to spectra.
+
+    Returns
+    -------
+    gof: dict
+        'rmse' and 'ks' arrays, see `fit_spectra`.
+    '''
+    Nd = np.ma.filled(np.ma.asarray(Nd, dtype=float), 0)
+    fitted = model_psd(model, D, params)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        residual = np.log10(Nd) - np.log10(fitted)
+        valid = (Nd > 0) & np.isfinite(residual)
+        rmse = np.sqrt(np.sum(np.where(valid, residual, 0) ** 2, axis=1) /
+                       np.sum(valid, axis=1))
+        observed = np.cumsum(Nd * dD, axis=1)
+        expected = np.cumsum(fitted * dD, axis=1)
+        ks = np.max(np.abs(observed / observed[:, -1:] -
+                           expected / expected[:, -1:]), axis=1)
+    return {'rmse': rmse, 'ks': ks}
+
+
+def _moment_orders(method):
+    ''' Moment orders used by a method of moments, e.g. (2, 4, 6). '''
+    digits = method.lstrip('t')[3:] if method.lstrip('t').startswith('mom') \
+        else ''
+    if method.lstrip('t').startswith('mom') and \
+            (not digits.isdigit() or len(set(digits)) != len(digits)):
+        raise ValueError("Method %s needs distinct single digit moment "
+                         "orders, e.g. mom246." % method)
+    return tuple(sorted(int(digit) for digit in digits))
+
+
+def _fit(Nd, D, dD, model, method, orders, moments, D_range, max_iter,
+         tol):
+    ''' Run an estimator, returns the parameters and convergence flags. '''
+    n = len(Nd)
+    converged = np.ones(n, dtype=bool)
+    if method == 'lsq':
+        params = _fit_lsq(Nd, D, model)
+    elif method == 'ml':
+        params, converged = _fit_ml(Nd, D, dD, model, max_iter, tol)
+    elif method.startswith('tmom'):
+        params, converged = _fit_truncated_moments(
+            model, orders, moments, D_range, max_iter, tol)
+    else:
+        params = _fit_moments(model, orders, moments)
+
+    empty = ~(np.sum(Nd, axis=1) > 0)
+    for name in MODELS[model]:
+        params[name] = np.where(empty, np.nan, params[name])
+    return params, converged & ~empty
+
+
+def _fit_parallel(args, n_workers):
+    ''' Run `_fit` over chunks of spectra in a process pool. '''
+    Nd, moments = args[0], args[6]
+    n_workers = n_workers or multiprocessing.cpu_count()
+    bounds = np.linspace(0, len(Nd), min(len(Nd), 4 * n_workers) + 1)
+    bounds = bounds.astype(int)
+    with ProcessPoolExecutor(n_workers) as executor:
+        futures = [executor.submit(
+            _fit, Nd[start:stop], *(args[1:6] + (
+                None if moments is None else moments[start:stop],) +
+                args[7:])) for start, stop in zip(bounds[:-1], bounds[1:])]
+        results = [future.result() for future in futures]
+    params = dict((name, np.concatenate([result[0][name]
+                                         for result in results]))
+                  for name in results[0][0])
+    return params, np.concatenate([result[1] for result in results])
+
+
+def _fit_moments(model, orders, moments):
+    ''' Closed form method of moments from a (n, len(orders)) matrix. '''
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        if model == 'gamma':
+            return _gamma_moments(orders, moments)
+        if model == 'exponential':
+            return _exponential_moments(orders, moments)
+        return _lognormal_moments(orders, moments)
+
+
+def _gamma_moments(orders, moments):
+    if orders not in GAMMA_MOMENT_ORDERS:
+        raise ValueError("The gamma method of moments supports the orders "
+                         "234, 246 and 346.")
+    Ma, Mb, Mc = moments.T
+    if orders == (2, 3, 4):
+        eta = Mb ** 2 / (Ma * Mc)
+        mu = (4 * eta - 3) / (1 - eta)
+        Lambda = (mu + 4) * Mb / Mc
+    elif orders == (2, 4, 6):
+        # Ulbrich and Atlas (1998), see `ua98.shape`.
+        eta = Mb ** 2 / (Ma * Mc)
+        mu = ((7 - 11 * eta) - np.sqrt(eta ** 2 + 14 * eta + 1)) / \
+            (2 * (eta - 1))
+        Lambda = np.sqrt((mu + 3) * (mu + 4) * Ma / Mb)
+    else:
+        eta = Mb ** 3 / (Ma ** 2 * Mc)
+        mu = ((8 - 11 * eta) - np.sqrt(eta ** 2 + 8 * eta)) / \
+            (2 * (eta - 1))
+        Lambda = (mu + 4) * Ma / Mb
+    valid = (mu > -orders[0] - 1) & (Lambda > 0)
+    mu = np.where(valid, mu, np.nan)
+    Lambda = np.where(valid, Lambda, np.nan)
+    # N0 from the middle moment.
+    b = orders[1]
+    N0 = np.exp(np.log(Mb) + (b + mu + 1) * np.log(Lambda) -
+                gammaln(b + mu + 1))
+    return {'N0': N0, 'mu': mu, 'Lambda': Lambda}
+
+
+def _exponential_moments(orders, moments):
+    if len(orders) != 2:
+        raise ValueError("The exponential method of moments needs two "
+                         "moment orders, e.g. mom34.")
+    a, b = orders
+    Ma, Mb = moments.T
+    Lambda = np.exp((gammaln(b + 1) - gammaln(a + 1) + np.log(Ma) -
+                     np.log(Mb)) / (b - a))
+    N0 = Ma * Lambda ** (a + 1) / np.exp(gammaln(a + 1))
+    return {'N0': N0, 'Lambda': Lambda}
+
+
+def _lognormal_moments(orders, moments):
+    # ln(Mn) = ln(Nt) + n mu + n^2 sigma^2 / 2 is a parabola in n.
+    if len(orders) != 3:
+        raise ValueError("The lognormal method of moments needs three "
+                         "moment orders, e.g. mom346.")
+    n = np.asarray(orders, dtype=float)
+    A = np.column_stack([np.ones(3), n, n ** 2 / 2])
+    coefficients = np.dot(np.log(moments), np.linalg.inv(A).T)
+    variance = coefficients[:, 2]
+    valid = variance > 0
+    sigma = np.where(valid, np.sqrt(np.where(valid, variance, 1)), np.nan)
+    return {'Nt': np.where(valid, np.exp(coefficients[:, 0]), np.nan),
+            'mu': np.where(valid, coefficients[:, 1], np.nan),
+            'sigma': sigma}
+
+
+def _truncation(model, orders, params, D_range):
+    ''' Fraction of each moment of the model inside D_range. '''
+    D_min, D_max = D_range
+    n = np.asarray(orders, dtype=float)
+    if model == 'lognormal':
+        mu = params['mu'][:, np.newaxis]
+        sigma = params['sigma'][:, np.newaxis]
+        return ndtr((np.log(D_max) - mu) / sigma - n * sigma) - \
+            ndtr((np.log(D_min) - mu) / sigma - n * sigma)
+    mu = params.get('mu', np.zeros_like(params['Lambda']))[:, np.newaxis]
+    Lambda = params['Lambda'][:, np.newaxis]
+    return gammainc(n + mu + 1, Lambda * D_max) - \
+        gammainc(n + mu + 1, Lambda * D_min)
+
+
+def _fit_truncated_moments(model, orders, moments, D_range, max_iter, tol):
+    ''' Method of moments corrected for the truncation to D_range.
+
+    The moments of the untruncated distribution are estimated by dividing
+    the measured ones by the fraction of each moment inside D_range for
+    the current fit, and refitted until the parameters settle.
+    '''
+    params = _fit_moments(model, orders, moments)
+    converged = np.zeros(len(moments), dtype=bool)
+    shape = MODELS[model][1:]
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        for i in range(max_iter):
+            fraction = _truncation(model, orders, params, D_range)
+            update = _fit_moments(model, orders, moments / fraction)
+            change = np.max([np.abs(update[name] - params[name]) /
+                             np.maximum(np.abs(params[name]), 1)
+                             for name in shape], axis=0)
+            # Keep the last valid estimate where the correction fails.
+            ok = np.isfinite(change)
+            for name in MODELS[model]:
+                params[name] = np.where(ok, update[name], params[name])
+            converged = ok & (change < tol)
+            if np.all(converged | ~ok):
+                break
+    return params, converged
+
+
+def _sufficient_statistics(model, D, dD):
+    ''' Sufficient statistics and base measure of the model as an
+    exponential family over the bins: N(D) dD ~ exp(theta.T(D) + h(D)).
+    '''
+    if model == 'gamma':
+        return np.column_stack([np.log(D), -D]), np.log(dD)
+    if model == 'exponential':
+        return -D[:, np.newaxis], np.log(dD)
+    return np.column_stack([np.log(D), np.log(D) ** 2]), \
+        np.log(dD) - np.log(D)
+
+
+def _fit_ml(Nd, D, dD, model, max_iter, tol, max_step=5.0):
+    ''' Maximum likelihood estimate of the shape of the distribution.
+
+    The drop counts of a spectrum are multinomial over the bins with
+    probabilities proportional to N(D) dD, an exponential family, so the
+    log likelihood is concave in the natural parameters theta and Newton
+    iterations converge from any starting point. The scale parameter
+    then matches the total number concentration.
+    '''
+    T, h = _sufficient_statistics(model, D, dD)
+    k = T.shape[1]
+    counts = Nd * dD
+    total = np.sum(counts, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        observed = np.dot(counts, T) / total[:, np.newaxis]
+        # Start from the continuous estimate of the log moments.
+        log_D = np.dot(counts, np.log(D)) / total
+        if model == 'lognormal':
+            variance = np.dot(counts, np.log(D) ** 2) / total - log_D ** 2
+            variance = np.maximum(variance, 0.01)
+            theta = np.column_stack([log_D / variance, -0.5 / variance])
+        elif model == 'gamma':
+            theta = np.column_stack([np.zeros(len(Nd)),
+                                     1 / np.exp(log_D)])
+        else:
+            theta = 1 / np.exp(log_D)[:, np.newaxis]
+    rows = np.nonzero(total > 0)[0]
+    theta[total <= 0] = np.nan
+    converged = np.zeros(len(Nd), dtype=bool)
+    TT = (T[:, :, np.newaxis] * T[:, np.newaxis, :]).reshape(len(D), k * k)
+    for i in range(max_iter):
+        if len(rows) == 0:
+            break
+        logits = np.dot(theta[rows], T.T) + h
+        p = np.exp(logits - np.max(logits, axis=1, keepdims=True))
+        p /= np.sum(p, axis=1, keepdims=True)
+        expected = np.dot(p, T)
+        covariance = np.dot(p, TT).reshape(-1, k, k) - \
+            expected[:, :, np.newaxis] * expected[:, np.newaxis, :]
+        covariance += 1e-12 * np.eye(k)
+        gradient = observed[rows] - expected
+        step = np.linalg.solve(covariance, gradient[:, :, np.newaxis])[..., 0]
+        scale = np.minimum(1, max_step / np.max(np.abs(step), axis=1))
+        theta[rows] += scale[:, np.newaxis] * step
+        done = np.max(np.abs(gradient), axis=1) < tol
+        converged[rows[done]] = True
+        rows = rows[~done]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if model == 'gamma':
+            params = {'mu': theta[:, 0], 'Lambda': theta[:, 1]}
+        elif model == 'exponential':
+            params = {'Lambda': theta[:, 0]}
+        else:
+            variance = -0.5 / theta[:, 1]
+            valid = variance > 0
+            params = {'mu': np.where(valid, theta[:, 0] * variance, np.nan),
+                      'sigma': np.sqrt(np.where(valid, variance, np.nan))}
+        scale_name = MODELS[model][0]
+        params[scale_name] = np.ones(len(Nd))
+        unit = np.dot(model_psd(model, D, params), dD)
+        params[scale_name] = total / unit
+    return params, converged
+
+
+def _fit_lsq(Nd, D, model):
+    ''' Least squares fit of log(N(D)) over the non-empty bins.
+
+    All models are linear in their log space parameters, so each spectrum
+    is fitted by solving its normal equations, all in one batch.
+    '''
+    if model == 'gamma':
+        A = np.column_stack([np.ones(len(D)), np.log(D), -D])
+    elif model == 'exponential':
+        A = np.column_stack([np.ones(len(D)), -D])
+    else:
+        A = np.column_stack([np.ones(len(D)), np.log(D), np.log(D) ** 2])
+    k = A.shape[1]
+    valid = Nd > 0
+    with np.errstate(divide='ignore'):
+        y = np.where(valid, np.log(np.where(valid, Nd, 1)), 0)
+    if model == 'lognormal':
+        y = np.where(valid, y + np.log(D), 0)
+    AA = (A[:, :, np.newaxis] * A[:, np.newaxis, :]).reshape(len(D), k * k)
+    normal = np.dot(valid.astype(float), AA).reshape(-1, k, k)
+    rhs = np.dot(y, A)
+    solvable = np.sum(valid, axis=1) >= k
+    normal[~solvable] = np.eye(k)
+    coefficients = np.linalg.solve(normal, rhs[:, :, np.newaxis])[..., 0]
+    coefficients[~solvable] = np.nan
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        if model == 'gamma':
+            return {'N0': np.exp(coefficients[:, 0]),
+                    'mu': coefficients[:, 1], 'Lambda': coefficients[:, 2]}
+        if model == 'exponential':
+            return {'N0': np.exp(coefficients[:, 0]),
+                    'Lambda': coefficients[:, 1]}
+        variance = np.where(coefficients[:, 2] < 0,
+                            -0.5 / coefficients[:, 2], np.nan)
+        mu = coefficients[:, 1] * variance
+        sigma = np.sqrt(variance)
+        Nt = np.sqrt(2 * np.pi) * sigma * \
+            np.exp(coefficients[:, 0] + mu ** 2 / (2 * variance))
+        return {'Nt': Nt, 'mu': mu, 'sigma': sigma}
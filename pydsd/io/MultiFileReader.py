@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+import functools
+from concurrent.futures import ProcessPoolExecutor
+
+from ..DropSizeDistribution import DropSizeDistribution
+
+
+def read_many(reader, paths, n_workers=None, **kwargs):
+    '''
+    Takes a reader function, such as read_parsivel, and a list of files and
+    returns a single drop size distribution object of all files, sorted by
+    time.
+
+    Usage:
+    dsd = read_many(read_parsivel, sorted(glob.glob('*.mis')), n_workers=4)
+
+    Parameters
+    ----------
+    reader: callable
+        Package reader function, called as reader(path, **kwargs).
+    paths: list of str
+        Files to read.
+    n_workers: optional, int
+        Number of worker processes reading files. Read in process if None.
+
+    Returns:
+    DropSizeDistribution object, see DropSizeDistribution.concatenate for
+    the handling of duplicate timestamps.
+
+    '''
+    paths = list(paths)
+    read = functools.partial(reader, **kwargs)
+    if n_workers and len(paths) > 1:
+        with ProcessPoolExecutor(n_workers) as pool:
+            dsds = list(pool.map(read, paths))
+    else:
+        dsds = [read(path) for path in paths]
+    return DropSizeDistribution.concatenate(
+        [dsd for dsd in dsds if dsd is not None])
@@ -46,3 +46,100 @@ def get_epoch_time(sample_times, t_units):
     eptime = {'data': timesec, 'units': EPOCH_UNITS,
               'standard_name': 'Time', 'long_name': 'Time (UTC)'}
     return eptime
+
+
+def categorical_to_dict(d):
+    """
+    Store the string data of a field dictionary as uint8 category codes.
+
+    The category names are kept in the CF style flag_values and
+    flag_meanings attributes, in sorted order. Empty strings are stored
+    as masked codes.
+    """
+    values = np.ma.filled(np.ma.asarray(d['data']), b'')
+    if values.dtype.kind == 'S' and values.ndim > 1:
+        values = netCDF4.chartostring(values)
+    values = np.char.strip(values.astype(str))
+    missing = values == ''
+    categories, codes = np.unique(values[~missing], return_inverse=True)
+    if len(categories) > 256:
+        raise ValueError("Too many categories for uint8 codes.")
+    data = np.zeros(values.shape, dtype=np.uint8)
+    data[~missing] = codes
+    d['data'] = np.ma.array(data, mask=missing)
+    d['flag_values'] = np.arange(len(categories), dtype=np.uint8)
+    d['flag_meanings'] = ' '.join(categories)
+    return d
+
+
+def decode_categorical(d):
+    """
+    Return the category names of a field stored by categorical_to_dict,
+    with empty strings for masked codes.
+
+    Fields that hold strings already are returned unchanged.
+    """
+    if 'flag_meanings' not in d:
+        return np.asarray(d['data'])
+    meanings = np.array(d['flag_meanings'].split(), dtype=str)
+    lookup = np.zeros(256, dtype=meanings.dtype)
+    lookup[np.asarray(d['flag_values'])] = meanings
+    names = lookup[np.ma.filled(d['data'], 0)]
+    names[np.ma.getmaskarray(d['data'])] = ''
+    return names
+
+
+def raw_matrix_to_nd(raw, diameter, spread, velocity, interval=60.0,
+                     sampling_area=0.0054):
+    """
+    Convert raw velocity-diameter count matrices to number concentrations.
+
+    The counts of all timesteps are converted in one contraction over the
+    velocity classes, N(D_i) = sum_j n_ij / (A_i dt V_ij dD_i).
+
+    Parameters
+    ----------
+    raw: array
+        Counts of shape (ntime, nvelocity, ndiameter).
+    diameter: array
+        Diameter of the bins in mm.
+    spread: array
+        Width of the diameter bins in mm.
+    velocity: array or callable
+        Fall velocity in m/s of the velocity classes, of shape (nvelocity,)
+        or (nvelocity, ndiameter). A callable is evaluated on diameter and
+        its fall velocity used for every velocity class instead.
+    interval: float or array
+        Sample interval in seconds, for all timesteps or per timestep.
+    sampling_area: float, array or callable
+        Sampling area in m^2, for all bins or per diameter bin. A callable
+        is evaluated on diameter.
+
+    Returns
+    -------
+    Nd: array
+        Number concentration in m^-3 mm^-1 of shape (ntime, ndiameter).
+    """
+    diameter = np.asarray(diameter, dtype=float)
+    if callable(velocity):
+        velocity = np.asarray(velocity(diameter))[np.newaxis, :]
+    velocity = np.asarray(velocity, dtype=float)
+    if velocity.ndim == 1:
+        velocity = velocity[:, np.newaxis]
+    if callable(sampling_area):
+        sampling_area = sampling_area(diameter)
+    # Weight of a count in each velocity-diameter class.
+    weights = 1.0 / (velocity * (np.asarray(sampling_area, dtype=float) *
+                                 np.asarray(spread, dtype=float)))
+    weights = np.broadcast_to(weights, np.shape(raw)[1:])
+    Nd = np.einsum('tji,ji->ti', raw, weights)
+    return Nd / np.reshape(interval, (-1, 1))
+
+
+def parsivel_sampling_area(diameter):
+    """
+    Effective sampling area in m^2 of the Parsivel laser beam, 180 mm long
+    and 30 mm wide, less the part where drops of diameter D (mm) only
+    partially cross the beam.
+    """
+    return 180e-6 * (30.0 - np.asarray(diameter) / 2.0)
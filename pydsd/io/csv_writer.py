@@ -13,6 +13,7 @@ import csv
 import pathlib
 import numpy as np
 
+from . import common
 
 np.set_printoptions(threshold=np.inf)
 
@@ -89,6 +90,7 @@ def write_csv_file(dsd, date, var,
     filelist = glob.glob(fname)
     np.ma.set_fill_value(dsd.fields[var]['data'], fillvalue)
     data = dsd.fields[var]['data'].filled()
+    precip_code = common.decode_categorical(dsd.fields['Precip_Code'])
     if not filelist:
         with open(basepath+datapath+fname, 'w', newline='') as csvfile:
             csvfile.write('# Disdrometer timeseries data file\n')
@@ -122,7 +124,7 @@ def write_csv_file(dsd, date, var,
             for i in range(len(dsd.time['data'])):
                 writer.writerow(
                     {'date': dsd.time['data'][i],
-                     'Precip Code': dsd.fields['Precip_Code']['data'][i],
+                     'Precip Code': precip_code[i],
                      get_fieldname_pyrad(var): data[i],
                      'Scattering Temp [deg C]': dsd.scattering_temp})
             csvfile.close()
@@ -134,7 +136,7 @@ def write_csv_file(dsd, date, var,
             for i in range(len(dsd.time['data'])):
                 writer.writerow(
                     {'date': dsd.time['data'][i],
-                     'Precip Code': dsd.fields['Precip_Code']['data'][i],
+                     'Precip Code': precip_code[i],
                      get_fieldname_pyrad(var): data[i],
                      'Scattering Temp [deg C]': dsd.scattering_temp})
             csvfile.close()
@@ -0,0 +1,34 @@
+import numpy as np
+import unittest
+
+from ..DSDProcessor import DSDProcessor
+
+
+class TestDSDProcessor(unittest.TestCase):
+    """Test module for the gamma DSD radar processor"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.processor = DSDProcessor()
+
+    def test_batch_matches_single_point(self):
+        D0 = np.array([0.8, 1.5, 2.5])
+        Nw = np.array([3.0, 3.5, 4.0])
+        mu = np.array([-1.0, 3.0, 8.0])
+        batch = self.processor.calcParametersBatch(D0, Nw, mu, chunk_size=2)
+        for i in range(len(D0)):
+            single = self.processor.calcParameters(D0[i], Nw[i], mu[i])
+            for key, value in single.items():
+                self.assertTrue(np.isclose(value, batch[key][i]),
+                                'Batch %s differs from single point' % key)
+
+    def test_batch_broadcasts_parameter_grid(self):
+        D0, Nw, mu = np.meshgrid([1.0, 2.0], [3.0, 4.0], [0.0, 5.0],
+                                 indexing='ij')
+        serial = self.processor.calcParametersBatch(D0, Nw, mu)
+        parallel = self.processor.calcParametersBatch(D0, Nw, mu,
+                                                      n_workers=2,
+                                                      chunk_size=3)
+        self.assertEqual(serial['Kdp'].shape, (2, 2, 2))
+        for key in serial:
+            self.assertTrue(np.allclose(serial[key], parallel[key]))
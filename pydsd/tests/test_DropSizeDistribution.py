@@ -1,13 +1,389 @@
 # -*- coding: utf-8 -*-
 
+import shutil
+import tempfile
+
 import numpy as np
 import unittest
 
 from .. import DropSizeDistribution
+from ..io import MultiFileReader, ParsivelReader, common
+from ..utility import scattering
+from ..utility.psd import normalized_gamma
+from ..utility.scattering_cache import ScatteringTableCache
 
 class testDropSizeDistribution(unittest.TestCase):
     ''' Unit tests for DropSizeDistribution Class'''
 
     def setUp(self):
-        pass
+        filename = 'testdata/parsivel_telegraph_testfile.mis'
+        self.dsd = ParsivelReader.read_parsivel(filename)
+        rng = np.random.RandomState(0)
+        self.dsd.Nd['data'] = np.ma.array(
+            rng.gamma(1.0, 100.0, (6, 32)) * (rng.rand(6, 32) < 0.5))
+        self.dsd.fields['Precip_Code'] = {'data': np.array(['RA'] * 6)}
+        self.cache_dir = tempfile.mkdtemp()
+        self.dsd.scattering_cache = ScatteringTableCache(self.cache_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_multiband_matches_single_band(self):
+        self.dsd.calculate_radar_parameters_multiband([2.8e9, 9.7e9],
+                                                      n_workers=2)
+        self.dsd.calculate_radar_parameters(method='kernel')
+        self.assertEqual(self.dsd.scattering_cache.hits, 1)
+        for field in ['Zh', 'Zdr', 'Kdp', 'Ai']:
+            self.assertIn(field + '_S', self.dsd.fields)
+            self.assertTrue(np.allclose(self.dsd.fields[field + '_X']['data'],
+                                        self.dsd.fields[field]['data']))
+        self.assertFalse(np.allclose(self.dsd.fields['Kdp_S']['data'],
+                                     self.dsd.fields['Kdp_X']['data']))
+
+    def test_repeated_and_empty_spectra_are_scattered_once(self):
+        self.dsd.Nd['data'][1] = self.dsd.Nd['data'][0]
+        self.dsd.Nd['data'][2] = 0
+        self.dsd.calculate_radar_parameters(method='kernel')
+        self.assertEqual(self.dsd.scattering_stats,
+                         {'hits': 1, 'misses': 4, 'empty': 1})
+        Zh = self.dsd.fields['Zh']['data']
+        self.assertEqual(Zh[0], Zh[1])
+        self.assertTrue(Zh.mask[2])
+        self.assertFalse(Zh.mask[0])
+
+        self.dsd.set_storage('compact')
+        self.dsd.calculate_radar_parameters(method='kernel')
+        self.assertTrue(np.isnan(self.dsd.fields['Zdr']['data'][2]))
+
+    def test_per_timestep_temperature_interpolates_tables(self):
+        self.dsd.set_scattering_temperature_and_frequency(
+            [5., 10., 7.5, np.nan, 5., 10.])
+        self.dsd.calculate_radar_parameters(method='kernel')
+        Kdp = self.dsd.fields['Kdp']['data'].copy()
+        self.assertTrue(Kdp.mask[3])
+
+        fixed = {}
+        for temp in [5., 10.]:
+            self.dsd.set_scattering_temperature_and_frequency(temp)
+            self.dsd.calculate_radar_parameters(method='kernel')
+            fixed[temp] = self.dsd.fields['Kdp']['data']
+        self.assertTrue(np.isclose(Kdp[0], fixed[5.][0]))
+        self.assertTrue(np.isclose(Kdp[1], fixed[10.][1]))
+        self.assertTrue(np.isclose(Kdp[2], (fixed[5.][2] + fixed[10.][2]) / 2))
+
+    def test_selected_fields_skip_forward_scattering(self):
+        self.dsd.calculate_radar_parameters(method='kernel',
+                                            fields=['Zh', 'Zdr'])
+        self.assertEqual(self.dsd.scatterer.psd_integrator.geometries,
+                         (scattering.BACK,))
+        self.assertNotIn('Kdp', self.dsd.fields)
+        Zh = self.dsd.fields['Zh']['data'].copy()
+        Zdr = self.dsd.fields['Zdr']['data'].copy()
+
+        self.dsd.calculate_radar_parameters(method='kernel')
+        self.assertTrue(np.allclose(Zh, self.dsd.fields['Zh']['data']))
+        self.assertTrue(np.allclose(Zdr, self.dsd.fields['Zdr']['data']))
+        self.assertIn('Kdp', self.dsd.fields)
+
+        with self.assertRaises(ValueError):
+            self.dsd.calculate_radar_parameters(fields=['Zx'])
+
+    def test_table_accuracy_sets_table_layout(self):
+        self.dsd.calculate_radar_parameters(method='kernel', fields=['Zh'])
+        Zh = self.dsd.fields['Zh']['data'].copy()
+        self.assertEqual(self.dsd.scattering_table_info['num_points'], 1024)
+
+        self.dsd.calculate_radar_parameters(method='kernel', fields=['Zh'],
+                                            table_accuracy=0.2)
+        info = self.dsd.scattering_table_info
+        self.assertEqual(self.dsd.scatterer.psd_integrator.num_points,
+                         info['num_points'])
+        self.assertLess(info['num_points'], 1024)
+        self.assertLessEqual(info['expected_error'], 0.2)
+        self.assertTrue(np.allclose(Zh, self.dsd.fields['Zh']['data'],
+                                    atol=0.5))
+
+    def test_moments_are_computed_once_per_Nd(self):
+        moments = self.dsd.calculate_moments([0, 3, 6])
+        self.assertEqual(moments.shape, (6, 3))
+        D = np.array(self.dsd.diameter['data'])
+        dD = np.array(self.dsd.spread['data'])
+        expected = np.dot(self.dsd.Nd['data'], D ** 3 * dD)
+        self.assertTrue(np.allclose(moments[:, 1], expected))
+        self.assertEqual(sorted(self.dsd.moments), [0, 3, 6])
+
+        self.dsd.moments[3] = np.zeros(6)
+        self.assertTrue(np.all(self.dsd.calculate_moments([3]) == 0))
+        self.dsd.Nd['data'] = 2 * self.dsd.Nd['data']
+        self.assertTrue(np.allclose(self.dsd.calculate_moments([3])[:, 0],
+                                    2 * expected))
+        self.dsd.Nd['data'] *= 0.5
+        self.dsd.invalidate_moments()
+        self.assertTrue(np.allclose(self.dsd._calc_mth_moment(3), expected))
+
+    def test_batch_D0_matches_single_spectrum(self):
+        Nd = np.ma.filled(self.dsd.Nd['data'], 0)
+        Nd[2] = 0
+        Nd[3] = 0
+        Nd[3, 0] = 1e6
+        Nd[3, 1] = 1.0
+        D0 = self.dsd._calculate_D0_batch(Nd, chunk_size=4)
+        self.assertEqual(D0[2], 0)
+        for t in range(len(Nd)):
+            self.assertEqual(D0[t], self.dsd._calculate_D0(Nd[t]))
+
+        # Half of the water in the first bin wraps around to the last one.
+        D = self.dsd.diameter['data']
+        W = np.cumsum(Nd[3] * np.array(self.dsd.spread['data']) * D ** 3)
+        slope = (W[0] - W[-1]) / (D[0] - D[-1])
+        self.assertAlmostEqual(D0[3], D[-1] + (0.5 * W[-1] - W[-1]) / slope)
+
+    def test_batch_mu_matches_single_estimate(self):
+        rng = np.random.RandomState(1)
+        D0 = rng.uniform(0.8, 2.5, 6)
+        mu = rng.uniform(-1, 10, 6)
+        self.dsd.Nd['data'] = np.ma.array(
+            normalized_gamma(self.dsd.diameter['data'], D0, 10 ** 3.5, mu) *
+            rng.lognormal(0, 0.3, (6, 32)))
+        self.dsd.Nd['data'][4] = 0
+        self.dsd.calculate_dsd_parameterization()
+        batch = self.dsd.fields['mu']['data']
+        self.assertTrue(np.isnan(batch[4]))
+        for t in [0, 1, 2, 3, 5]:
+            self.assertAlmostEqual(batch[t], self.dsd._estimate_mu(t),
+                                   places=3)
+
+    def test_rain_rate_velocity_options(self):
+        D = np.array(self.dsd.diameter['data'])
+        dD = np.array(self.dsd.spread['data'])
+        Nd = np.ma.filled(self.dsd.Nd['data'], 0)
+        d3 = np.where(np.arange(32) < self.dsd._find_nearest(D, 30), D ** 3,
+                      0)
+        atlas = 9.65 - 10.3 * np.exp(-0.6 * D)
+        atlas[0] = 0.5
+
+        self.dsd.calculate_RR()
+        expected = 0.6 * np.pi * 1e-3 * np.sum(atlas * Nd * dD * d3, axis=1)
+        self.assertTrue(np.allclose(self.dsd.fields['RR']['data'], expected))
+
+        self.dsd.calculate_RR(velocity=2 * atlas)
+        self.assertTrue(np.allclose(self.dsd.fields['RR']['data'],
+                                    2 * expected))
+
+        measured = np.tile(atlas, (6, 1))
+        measured[0] *= 3
+        measured[1] = 0
+        self.dsd.velocity = {'data': measured}
+        self.dsd.calculate_RR(velocity='measured')
+        RR = self.dsd.fields['RR']['data']
+        self.assertTrue(np.allclose(RR[0], 3 * expected[0]))
+        self.assertTrue(np.allclose(RR[1:], expected[1:]))
+        self.dsd.calculate_RR(velocity=measured)
+        self.assertEqual(self.dsd.fields['RR']['data'][1], 0)
+
+    def test_derived_fields_are_computed_on_access(self):
+        self.assertNotIn('D0', self.dsd.fields)
+        D0 = self.dsd.fields['D0']['data']
+        self.assertNotIn('mu', self.dsd.fields)
+        self.assertNotIn('Zh', self.dsd.fields)
+        self.assertTrue(np.allclose(D0, self.dsd._calculate_D0_batch(
+            self.dsd.Nd['data'])))
+
+        Nw = self.dsd.fields['Nw']['data']
+        self.assertIn('W', self.dsd.fields)
+        self.assertIn('Dm', self.dsd.fields)
+        self.assertIs(self.dsd.fields['Nw']['data'], Nw)
+
+        self.dsd.calculate_dsd_parameterization()
+        self.assertTrue(np.allclose(self.dsd.fields['Nw']['data'], Nw))
+
+        with self.assertRaises(KeyError):
+            self.dsd.fields['not_a_field']
+
+    def test_derived_fields_are_dropped_when_Nd_changes(self):
+        D0 = self.dsd.fields['D0']['data'].copy()
+        Nw = self.dsd.fields['Nw']['data'].copy()
+        self.dsd.calculate_RR(velocity='measured')
+        self.dsd.Nd['data'] = self.dsd.Nd['data'] * 2.0
+        self.assertNotIn('RR', self.dsd.fields)
+        self.assertTrue(np.allclose(self.dsd.fields['D0']['data'], D0))
+        self.assertTrue(np.allclose(self.dsd.fields['Nw']['data'], 2 * Nw))
+
+        # In place changes need invalidate_moments.
+        self.dsd.Nd['data'] *= 2.0
+        self.assertTrue(np.allclose(self.dsd.fields['Nw']['data'], 2 * Nw))
+        self.dsd.invalidate_moments()
+        self.assertTrue(np.allclose(self.dsd.fields['Nw']['data'], 4 * Nw))
+
+    def test_precip_mask_from_categorical_codes(self):
+        codes = np.array(['RA', 'NP', 'RASN', 'GS', '', 'RA'])
+        expected = [False, True, True, True, False, False]
+        self.dsd.fields['Precip_Code'] = {'data': codes}
+        self.assertEqual(list(self.dsd._precip_mask()), expected)
+        self.dsd.fields['Precip_Code'] = common.categorical_to_dict(
+            {'data': codes})
+        mask = self.dsd._precip_mask()
+        self.assertEqual(list(mask), expected)
+        self.assertIs(self.dsd._precip_mask(), mask)
+
+        del self.dsd.fields['Precip_Code']
+        self.assertFalse(np.any(self.dsd._precip_mask()))
+        self.assertFalse(np.ma.is_masked(self.dsd.fields['D0']['data']))
+
+    def test_missing_precip_codes_stay_masked_when_appending(self):
+        self.dsd.fields['Precip_Code'] = common.categorical_to_dict(
+            {'data': np.array(['RA', 'NP', '', 'RA', 'RA', 'RA'])})
+        time = np.asarray(self.dsd.time['data'])
+        self.dsd.append({'time': time[-1:] + 60, 'Nd': self.dsd.Nd['data'][0],
+                         'Precip_Code': np.array(['SN'])})
+        self.dsd.append({'time': time[-1:] + 120,
+                         'Nd': self.dsd.Nd['data'][0]})
+        code = self.dsd.fields['Precip_Code']
+        self.assertEqual(code['flag_meanings'], 'NP RA SN')
+        self.assertEqual(list(np.ma.getmaskarray(code['data'])),
+                         [False, False, True, False, False, False, False,
+                          True])
+        self.assertEqual(list(common.decode_categorical(code)),
+                         ['RA', 'NP', '', 'RA', 'RA', 'RA', 'SN', ''])
+
+    def test_compact_storage_matches_masked_storage(self):
+        self.dsd.fields['Precip_Code'] = {
+            'data': np.array(['RA', 'NP', 'RA', 'RA', 'RA', 'RA'])}
+        self.dsd.calculate_dsd_parameterization()
+        self.dsd.calculate_RR()
+        masked = dict((name, self.dsd.fields[name]['data'].copy())
+                      for name in ['D0', 'Nw', 'mu', 'RR'])
+
+        self.dsd.set_storage('compact')
+        self.assertEqual(self.dsd.Nd['data'].dtype, np.float32)
+        self.assertFalse(np.ma.isMaskedArray(self.dsd.fields['D0']['data']))
+        self.dsd.calculate_dsd_parameterization()
+        self.dsd.calculate_RR()
+        for name, data in masked.items():
+            compact = self.dsd.fields[name]['data']
+            self.assertEqual(compact.dtype, np.float32)
+            self.assertFalse(np.ma.isMaskedArray(compact))
+            self.assertTrue(np.allclose(np.ma.filled(data, np.nan), compact,
+                                        rtol=1e-5, equal_nan=True))
+        self.assertTrue(np.isnan(self.dsd.fields['D0']['data'][1]))
+
+        self.dsd.set_storage('masked')
+        self.assertTrue(self.dsd.fields['D0']['data'].mask[1])
+        with self.assertRaises(ValueError):
+            self.dsd.set_storage('sparse')
+
+    def test_append_matches_full_record(self):
+        full = self.dsd
+        full.fields['Precip_Code'] = common.categorical_to_dict(
+            {'data': np.array(['RA', 'NP', 'RA', '-RA', 'RA', 'RASN'])})
+
+        dsd = ParsivelReader.read_parsivel(
+            'testdata/parsivel_telegraph_testfile.mis')
+        dsd.scattering_cache = full.scattering_cache
+        dsd.numt = 2
+        dsd.time['data'] = full.time['data'][:2]
+        for name, field in full.fields.items():
+            dsd.fields[name] = dict(field, data=field['data'][:2])
+        dsd.Nd = dsd.fields['Nd']
+        dsd.velocity = dsd.fields['terminal_velocity']
+
+        for record in [full, dsd]:
+            record.calculate_dsd_parameterization()
+            record.calculate_RR(velocity='measured')
+            record.calculate_radar_parameters(method='kernel',
+                                              fields=['Zh', 'Kdp'])
+            record.calculate_moments([0, 3])
+        codes = np.array(['RA', 'NP', 'RA', '-RA', 'RA', 'RASN'])
+        for t in range(2, 6):
+            dsd.append({'time': full.time['data'][t:t + 1],
+                        'Nd': full.Nd['data'][t],
+                        'terminal_velocity':
+                            full.fields['terminal_velocity']['data'][t:t + 1],
+                        'Precip_Code': codes[t:t + 1]})
+            if t == 4:
+                Nd = dsd.Nd['data']
+        # Capacity doubling extends the same buffer.
+        self.assertTrue(np.shares_memory(Nd, dsd.Nd['data']))
+
+        self.assertEqual(dsd.numt, 6)
+        self.assertEqual(dsd.scattering_stats['misses'],
+                         full.scattering_stats['misses'])
+        self.assertEqual(list(common.decode_categorical(
+            dsd.fields['Precip_Code'])), list(codes))
+        self.assertEqual(sorted(dsd.moments), sorted(full.moments))
+        self.assertTrue(np.allclose(dsd.calculate_moments([0, 3]),
+                                    full.calculate_moments([0, 3])))
+        for name in ['D0', 'Nw', 'mu', 'N0', 'RR', 'Zh', 'Kdp']:
+            appended = dsd.fields[name]['data']
+            expected = full.fields[name]['data']
+            self.assertEqual(list(np.ma.getmaskarray(appended)),
+                             list(np.ma.getmaskarray(expected)))
+            self.assertTrue(np.allclose(appended, expected))
+        self.assertNotIn('Zdr', dsd.fields)
+
+    def test_chunked_processing_matches_whole_record(self):
+        self.dsd.fields['Precip_Code'] = {
+            'data': np.array(['RA', 'NP', 'RA', 'RA', 'RA', 'RA'])}
+        self.dsd.calculate_dsd_parameterization()
+        self.dsd.calculate_RR(velocity='measured')
+        self.dsd.calculate_radar_parameters(method='kernel')
+        names = ['D0', 'Nw', 'mu', 'RR', 'Zh', 'Kdp']
+        expected = dict((name, np.ma.filled(self.dsd.fields[name]['data'],
+                                            np.nan)) for name in names)
+
+        chunks = list(self.dsd.iter_chunks(4))
+        self.assertEqual([chunk.numt for chunk in chunks], [4, 2])
+        self.assertTrue(np.allclose(chunks[1].fields['D0']['data'],
+                                    expected['D0'][4:], equal_nan=True))
+
+        for directory in [None, self.cache_dir]:
+            for name in names:
+                del self.dsd.fields[name]
+            self.dsd.scattering_stats = {'hits': 0, 'misses': 0, 'empty': 0}
+            self.dsd.set_chunking(4, directory)
+            self.dsd.calculate_RR(velocity='measured')
+            self.dsd.calculate_radar_parameters(method='kernel')
+            self.assertEqual(self.dsd.scattering_stats['misses'], 6)
+            for name in names:
+                data = self.dsd.fields[name]['data']
+                self.assertEqual(len(data), 6)
+                self.assertTrue(np.allclose(np.ma.filled(data, np.nan),
+                                            expected[name], equal_nan=True))
+        self.assertIsInstance(self.dsd.Nd['data'], np.memmap)
+        self.assertIsInstance(self.dsd.fields['mu']['data'], np.memmap)
+        self.assertTrue(np.isnan(self.dsd.fields['D0']['data'][1]))
+
+    def test_concatenate_sorts_and_drops_duplicate_times(self):
+        self.dsd.fields['Precip_Code'] = common.categorical_to_dict(
+            {'data': np.array(['RA', 'NP', 'RA', 'RA', 'SN', 'RA'])})
+        self.dsd.calculate_dsd_parameterization()
+        time = np.asarray(self.dsd.time['data'])
+        later = self.dsd._chunk(slice(3, 6))
+        earlier = self.dsd._chunk(slice(0, 4))
+        later.fields['Precip_Code'] = common.categorical_to_dict(
+            {'data': np.array(['RA', 'SN', 'RA'])})
+        merged = DropSizeDistribution.DropSizeDistribution.concatenate(
+            [later, earlier])
+        self.assertEqual(merged.numt, 6)
+        self.assertTrue(np.array_equal(merged.time['data'], time))
+        self.assertTrue(np.ma.allequal(merged.Nd['data'], self.dsd.Nd['data']))
+        self.assertEqual(
+            common.decode_categorical(merged.fields['Precip_Code']).tolist(),
+            ['RA', 'NP', 'RA', 'RA', 'SN', 'RA'])
+        self.assertTrue(np.allclose(merged.fields['D0']['data'],
+                                    self.dsd.fields['D0']['data']))
+
+        later.bin_edges = {'data': np.arange(33.0)}
+        with self.assertRaises(ValueError):
+            DropSizeDistribution.DropSizeDistribution.concatenate(
+                [earlier, later])
 
+    def test_read_many_matches_single_file(self):
+        filename = 'testdata/parsivel_telegraph_testfile.mis'
+        single = ParsivelReader.read_parsivel(filename)
+        for n_workers in [None, 2]:
+            dsd = MultiFileReader.read_many(ParsivelReader.read_parsivel,
+                                            [filename] * 2, n_workers)
+            self.assertEqual(dsd.numt, 6)
+            self.assertTrue(np.ma.allequal(dsd.Nd['data'],
+                                           single.Nd['data']))
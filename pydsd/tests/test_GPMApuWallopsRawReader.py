@@ -0,0 +1,46 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from ..aux_readers import GPMApuWallopsRawReader
+
+
+class TestGPMApuWallopsRawReader(unittest.TestCase):
+    """Test module for the GPMApuWallopsRawReader on a synthetic file"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'apu01.20140501.csv')
+        np.random.seed(5)
+        self.raw = np.random.randint(0, 5, size=(3, 1024))
+        with open(self.filename, 'w') as f:
+            for t, counts in enumerate(self.raw):
+                row = ['20140501%02d%02d00' % (12, t), '0', '0',
+                       str(counts.sum()), '1.5', '0', '0', '0', '0']
+                f.write(','.join(row + [str(c) for c in counts]) + '\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_can_read_sample_file(self):
+        dsd = GPMApuWallopsRawReader.read_gpm_nasa_apu_raw_wallops(
+            self.filename)
+        self.assertEqual(dsd.numt, 3)
+        self.assertEqual(np.diff(dsd.time['data']).tolist(), [60.0, 60.0])
+        self.assertEqual(len(dsd.bin_edges['data']), 33)
+
+    def test_nd_uses_fall_velocity_of_diameter_class(self):
+        reader = GPMApuWallopsRawReader.GPMApuWallopsRawReader(self.filename)
+        v = reader.velocity['data']
+        dD = reader.spread['data']
+        Md = self.raw.reshape(-1, 32, 32)
+        for t in range(3):
+            expected = [
+                sum(Md[t, j, i] / (0.0054 * 10.0 * v[i] * dD[i])
+                    for j in range(32))
+                for i in range(32)]
+            self.assertTrue(np.allclose(reader.fields['Nd']['data'][t],
+                                        expected))
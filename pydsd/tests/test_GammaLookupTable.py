@@ -0,0 +1,60 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from ..DSDProcessor import DSDProcessor
+from ..GammaLookupTable import GammaLookupTable, MOMENTS
+
+
+class TestGammaLookupTable(unittest.TestCase):
+    """Test module for the gamma DSD radar lookup table"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.processor = DSDProcessor()
+        cls.table = GammaLookupTable.from_processor(
+            cls.processor, D0=np.arange(1.0, 2.01, 0.1),
+            log10_Nw=np.arange(2.0, 5.01, 0.5), mu=np.arange(0.0, 6.01, 1.0))
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_query_on_grid_nodes_returns_table_values(self):
+        result = self.table(1.3, 3.5, 4.0)
+        for key in MOMENTS:
+            self.assertTrue(np.isclose(result[key],
+                                       self.table.moments[key][3, 3, 4]))
+
+    def test_query_between_nodes_is_close_to_direct_calculation(self):
+        D0 = np.array([1.25, 1.72])
+        Nw = np.array([3.3, 4.1])
+        mu = np.array([2.5, 4.5])
+        result = self.table(D0, Nw, mu)
+        direct = self.processor.calcParametersBatch(D0, Nw, mu)
+        self.assertTrue(np.allclose(result['Zh'], direct['Zh'], atol=0.1))
+        self.assertTrue(np.allclose(result['Kdp'], direct['Kdp'], rtol=0.05))
+
+    def test_query_outside_table_is_nan(self):
+        result = self.table([0.5, 1.5], 3.0, 2.0, variables=['Zh'])
+        self.assertEqual(list(result), ['Zh'])
+        self.assertTrue(np.isnan(result['Zh'][0]))
+        self.assertFalse(np.isnan(result['Zh'][1]))
+
+    def test_save_and_load_roundtrip(self):
+        for name in ['table.nc', 'table.npz']:
+            filename = os.path.join(self.tmp_dir, name)
+            self.table.save(filename)
+            table = GammaLookupTable.load(filename)
+            self.assertTrue(np.array_equal(table.mu, self.table.mu))
+            self.assertTrue(np.allclose(table.info['wavelength'],
+                                        self.table.info['wavelength']))
+            self.assertEqual(table.info['dsr'], self.table.info['dsr'])
+            for key in MOMENTS:
+                self.assertTrue(np.array_equal(table.moments[key],
+                                               self.table.moments[key]))
@@ -1,3 +1,6 @@
+import io
+import os
+import tempfile
 import numpy as np
 import unittest
 import datetime
@@ -45,3 +48,125 @@ class TestParsivelReader(unittest.TestCase):
         time_secs = [(timestamp-epoch).total_seconds() for timestamp in time_array]
         self.assertEqual(time_secs[0], self.dsd.time['data'][0])
         # self.assertItemsEqual(time_secs, self.dsd.time['data']) # Might bring this back with six
+
+    def test_telegram_lines_parse_like_python(self):
+        lines = []
+        with io.open('testdata/parsivel_telegraph_testfile.mis',
+                     encoding='latin-1') as f:
+            for line in f:
+                if line.startswith('90:'):
+                    lines.append(line.rstrip('\n\r;').split(':')[1])
+        expected = [np.power(10, list(map(float, line.split(';'))))
+                    for line in lines]
+        self.assertTrue(np.array_equal(self.dsd.Nd['data'].data, expected))
+
+        padded = [b'001;020;300', b'000;007;010']
+        values = ParsivelReader.ParsivelReader._parse_values(padded, int, 3)
+        self.assertEqual(values.tolist(), [[1, 20, 300], [0, 7, 10]])
+        ragged = [b'1;20;300', b'0;-7;10']
+        values = ParsivelReader.ParsivelReader._parse_values(ragged, int, 3)
+        self.assertEqual(values.tolist(), [[1, 20, 300], [0, -7, 10]])
+        with self.assertRaises(ValueError):
+            ParsivelReader.ParsivelReader._parse_values(ragged, int, 4)
+
+        for floats, size in (([b'01.744;-0.645', b'00.000;12.125'], 2),
+                             ([b'0000.000', b'0012.345'], None),
+                             ([b'-9.999', b'00060'], None),
+                             ([b'1.5;-0.25', b'10;2e3'], 2)):
+            values = ParsivelReader.ParsivelReader._parse_values(floats,
+                                                                float, size)
+            expected = np.fromstring(b';'.join(floats), sep=';')
+            self.assertTrue(np.array_equal(values.ravel(), expected))
+
+    def test_iter_parsivel_chunks_match_full_read(self):
+        filename = 'testdata/parsivel_telegraph_testfile.mis'
+        chunks = list(ParsivelReader.iter_parsivel(
+            filename, chunk_size=4, block_size=100))
+        self.assertEqual([len(dsd.time['data']) for dsd in chunks], [4, 2])
+        self.assertEqual(
+            np.concatenate([dsd.time['data'] for dsd in chunks]).tolist(),
+            list(self.dsd.time['data']))
+        Nd = np.ma.concatenate([dsd.Nd['data'] for dsd in chunks])
+        self.assertTrue(np.ma.allequal(Nd, self.dsd.Nd['data']))
+
+    def test_iter_parsivel_skips_partial_telegrams(self):
+        with io.open('testdata/parsivel_telegraph_testfile.mis', 'rb') as f:
+            lines = f.readlines()
+        # Cut off the start of the first and the end of the last telegram.
+        handle, filename = tempfile.mkstemp(suffix='.mis')
+        with io.open(handle, 'wb') as f:
+            f.writelines(lines[5:-10])
+        try:
+            for chunk_size, block_size in [(2, 100), (4, 2 ** 20)]:
+                chunks = list(ParsivelReader.iter_parsivel(
+                    filename, chunk_size=chunk_size, block_size=block_size))
+                time = np.concatenate([dsd.time['data'] for dsd in chunks])
+                self.assertEqual(time.tolist(),
+                                 list(self.dsd.time['data'][1:5]))
+                for dsd in chunks:
+                    self.assertEqual(len(dsd.fields['rain_rate']['data']),
+                                     len(dsd.time['data']))
+                RR = np.concatenate(
+                    [dsd.fields['rain_rate']['data'] for dsd in chunks])
+                self.assertTrue(np.array_equal(
+                    RR, self.dsd.fields['rain_rate']['data'][1:5]))
+                Nd = np.ma.concatenate([dsd.Nd['data'] for dsd in chunks])
+                self.assertTrue(np.ma.allequal(Nd, self.dsd.Nd['data'][1:5]))
+        finally:
+            os.remove(filename)
+
+    def test_bad_or_missing_sample_interval_falls_back_to_one_minute(self):
+        with io.open('testdata/parsivel_telegraph_testfile.mis', 'rb') as f:
+            lines = f.readlines()
+        interval = [i for i, line in enumerate(lines)
+                    if line.startswith(b'09:')]
+        lines[interval[0]] = b'09:00030\n'
+        lines[interval[2]] = b'09:abc\n'
+        del lines[interval[4]]
+        reader = ParsivelReader.ParsivelReader(
+            'bad09.mis', data=b''.join(lines))
+        self.assertEqual(reader.sample_interval.tolist(),
+                         [30.0, 60.0, 60.0, 60.0, 60.0, 60.0])
+        self.assertEqual(len(reader.rain_rate), 6)
+
+    def test_raw_matrix_is_compact_and_filtered_on_access(self):
+        reader = ParsivelReader.ParsivelReader(
+            'testdata/parsivel_telegraph_testfile.mis')
+        self.assertEqual(reader.raw.shape, (6, 32, 32))
+        self.assertEqual(reader.raw.dtype, np.uint16)
+        pcm = np.reshape(reader.pcm_matrix, (32, 32))
+        expected = [pcm * sample for sample in reader.raw.astype(int)]
+        self.assertTrue(
+            np.array_equal(reader.filtered_raw_matrix, expected))
+
+    def test_nd_from_raw_matches_per_sample_conversion(self):
+        reader = ParsivelReader.ParsivelReader(
+            'testdata/parsivel_telegraph_testfile.mis')
+        np.random.seed(3)
+        reader.raw = np.random.randint(
+            0, 20, size=(6, 32, 32)).astype(np.uint16)
+        reader.sample_interval = np.array([60.0, 60, 60, 30, 30, 10])
+        Nd = reader.calculate_nd_from_raw()['data']
+
+        v = np.array(reader.velocity['data'])
+        dD = np.array(reader.spread['data'])
+        for t in range(6):
+            counts = reader.pcm * reader.raw[t].astype(float)
+            expected = [
+                sum(counts[j, i] / (0.0054 * reader.sample_interval[t] *
+                                    v[j] * dD[i]) for j in range(32))
+                for i in range(32)]
+            self.assertTrue(np.allclose(Nd[t], expected))
+
+        def area(D):
+            return 180e-6 * (30.0 - D / 2.0)
+
+        def fall_speed(D):
+            return 9.65 - 10.3 * np.exp(-0.6 * D)
+
+        Nd = reader.calculate_nd_from_raw(
+            velocity=fall_speed, sampling_area=area, filtered=False)['data']
+        D = reader.diameter['data']
+        expected = reader.raw.sum(axis=1) / (
+            area(D) * reader.sample_interval[:, None] * fall_speed(D) * dD)
+        self.assertTrue(np.allclose(Nd, expected))
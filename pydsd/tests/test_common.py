@@ -0,0 +1,24 @@
+import unittest
+
+import numpy as np
+
+from ..io import common
+
+
+class TestCommon(unittest.TestCase):
+    """Test module for the shared reader helpers"""
+
+    def test_categorical_roundtrip(self):
+        codes = np.array(['RA', 'NP', 'RA', '', 'GS', 'RA'])
+        d = common.categorical_to_dict({'data': codes.copy()})
+        self.assertEqual(d['data'].dtype, np.uint8)
+        self.assertEqual(d['flag_meanings'], 'GS NP RA')
+        self.assertEqual(list(np.ma.getmaskarray(d['data'])),
+                         [False, False, False, True, False, False])
+        decoded = common.decode_categorical(d)
+        self.assertEqual(list(decoded), list(codes))
+
+    def test_decode_passes_strings_through(self):
+        codes = np.array(['RA', 'NP'])
+        self.assertTrue(np.array_equal(
+            common.decode_categorical({'data': codes}), codes))
@@ -0,0 +1,88 @@
+import numpy as np
+import unittest
+
+from ..fit import psd_fit, ua98
+from ..io import ParsivelReader
+
+
+class TestPSDFit(unittest.TestCase):
+    ''' Tests of the batched size distribution fits. '''
+
+    def setUp(self):
+        self.D = np.arange(0.125, 8, 0.25)
+        self.dD = np.full(len(self.D), 0.25)
+        rng = np.random.RandomState(0)
+        self.params = {'mu': rng.uniform(-1, 8, 5),
+                       'Lambda': rng.uniform(2, 6, 5)}
+        self.params['N0'] = 1e4 * self.params['Lambda'] ** \
+            (self.params['mu'] + 1)
+        self.Nd = psd_fit.model_psd('gamma', self.D, self.params)
+        self.Nd[2] = 0
+
+    def assertRecovers(self, fit, params, rtol=1e-6, atol=1e-8):
+        for name, value in params.items():
+            self.assertTrue(np.isnan(fit[name][2]))
+            rows = [0, 1, 3, 4]
+            self.assertTrue(np.allclose(fit[name][rows], value[rows],
+                                        rtol=rtol, atol=atol), name)
+
+    def test_exact_estimators_recover_gamma_parameters(self):
+        for method in ['ml', 'lsq']:
+            fit = psd_fit.fit_spectra(self.Nd, self.D, self.dD, 'gamma',
+                                      method)
+            self.assertRecovers(fit, self.params)
+            self.assertTrue(np.all(fit['converged'][[0, 1, 3, 4]]))
+            self.assertLess(np.nanmax(fit['rmse']), 1e-6)
+            self.assertLess(np.nanmax(fit['ks']), 1e-6)
+
+    def test_moment_methods(self):
+        fit = psd_fit.fit_spectra(self.Nd, self.D, self.dD, 'gamma',
+                                  'mom246')
+        M2, M4, M6 = [np.dot(self.Nd, self.D ** m * self.dD)
+                      for m in [2, 4, 6]]
+        rows = [0, 1, 3, 4]
+        self.assertTrue(np.allclose(fit['mu'][rows],
+                                    ua98.shape(M2, M4, M6)[rows]))
+        for method in ['mom234', 'mom346', 'tmom246']:
+            fit = psd_fit.fit_spectra(self.Nd, self.D, self.dD, 'gamma',
+                                      method)
+            self.assertRecovers(fit, self.params, rtol=0.2)
+        with self.assertRaises(ValueError):
+            psd_fit.fit_spectra(self.Nd, self.D, self.dD, 'gamma', 'mom235')
+        with self.assertRaises(ValueError):
+            psd_fit.fit_spectra(self.Nd, self.D, self.dD, 'gamma', 'chi2')
+
+    def test_truncated_moments_recover_lognormal(self):
+        params = {'Nt': np.full(5, 1000.0),
+                  'mu': np.array([0.0, 0.2, 0.4, 0.6, -0.3]),
+                  'sigma': np.array([0.3, 0.4, 0.5, 0.35, 0.45])}
+        Nd = psd_fit.model_psd('lognormal', self.D, params)
+        Nd[2] = 0
+        fit = psd_fit.fit_spectra(Nd, self.D, self.dD, 'lognormal',
+                                  'tmom346')
+        self.assertRecovers(fit, params, rtol=1e-3, atol=1e-3)
+        exponential = psd_fit.fit_spectra(Nd, self.D, self.dD,
+                                          'exponential', 'ml')
+        self.assertEqual(sorted(exponential), ['Lambda', 'N0', 'converged',
+                                               'ks', 'rmse'])
+        self.assertGreater(np.nanmean(exponential['ks']),
+                           np.nanmean(fit['ks']))
+
+    def test_parallel_and_dsd_fits(self):
+        serial = psd_fit.fit_spectra(self.Nd, self.D, self.dD, 'gamma', 'ml')
+        parallel = psd_fit.fit_spectra(self.Nd, self.D, self.dD, 'gamma',
+                                       'ml', n_workers=2)
+        for name in ['N0', 'mu', 'Lambda', 'converged']:
+            self.assertTrue(np.allclose(serial[name], parallel[name],
+                                        equal_nan=True))
+
+        dsd = ParsivelReader.read_parsivel(
+            'testdata/parsivel_telegraph_testfile.mis')
+        params = dict((name, np.append(value, value[0]))
+                      for name, value in self.params.items())
+        dsd.Nd['data'] = np.ma.array(psd_fit.model_psd(
+            'gamma', dsd.diameter['data'], params))
+        fit = psd_fit.fit_dsd(dsd, 'gamma', 'mom234')
+        self.assertEqual(sorted(dsd.moments), [2, 3, 4])
+        self.assertEqual(len(fit['mu']), 6)
+        self.assertTrue(np.all(np.isfinite(fit['mu'])))
@@ -0,0 +1,78 @@
+import unittest
+
+import numpy as np
+
+from .. import DSR
+from ..io import ParsivelReader
+from ..utility import scattering
+
+
+class TestScattering(unittest.TestCase):
+    """Test module for the scattering table integration"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.setup = (30.0, complex(7.99, 2.2), DSR.bc, 10.0, 20.0, 64)
+        cls.scatterer = scattering.build_scatterer(*cls.setup)
+        cls.bin_edges = ParsivelReader.ParsivelReader.diameter['data'] + \
+            np.array(ParsivelReader.ParsivelReader.spread['data']) / 2
+        cls.bin_edges = np.hstack((0, cls.bin_edges))
+        rng = np.random.RandomState(0)
+        cls.Nd = rng.gamma(1.0, 100.0, (5, 32)) * (rng.rand(5, 32) < 0.5)
+        cls.Nd[2] = 0
+
+    def _variables(self, integrated):
+        return scattering.radar_variables(integrated,
+                                          self.scatterer.wavelength)
+
+    def test_kernel_matches_binned_integration(self):
+        binned = self._variables(scattering.integrate_binned(
+            self.scatterer, self.bin_edges, self.Nd))
+        kernels = scattering.bin_kernels(self.scatterer, self.bin_edges)
+        kernel = self._variables(scattering.integrate_kernels(kernels,
+                                                              self.Nd))
+        self.assertEqual(sorted(binned), sorted(scattering.RADAR_FIELDS))
+        for field in scattering.RADAR_FIELDS:
+            self.assertTrue(np.allclose(binned[field], kernel[field],
+                                        rtol=1e-10, equal_nan=True),
+                            'Kernel integration differs for %s' % field)
+
+    def test_kernel_is_linear_in_Nd(self):
+        kernels = scattering.bin_kernels(self.scatterer, self.bin_edges)
+        single = scattering.integrate_kernels(kernels, self.Nd[:1])
+        double = scattering.integrate_kernels(kernels, 2 * self.Nd[:1])
+        for geom in kernels:
+            self.assertTrue(np.allclose(2 * single[geom][1],
+                                        double[geom][1]))
+
+    def test_parallel_matches_serial_integration(self):
+        serial = scattering.integrate_binned(self.scatterer, self.bin_edges,
+                                             self.Nd)
+        parallel = scattering.integrate_binned_parallel(
+            self.setup, self.bin_edges, self.Nd, n_workers=2)
+        for geom in serial:
+            self.assertTrue(np.allclose(serial[geom][0], parallel[geom][0]))
+            self.assertTrue(np.allclose(serial[geom][1], parallel[geom][1]))
+
+    def test_unique_spectra_skips_empty_and_repeated_rows(self):
+        Nd = np.vstack((self.Nd, self.Nd[:2]))
+        rows, unique, inverse = scattering.unique_spectra(Nd)
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(len(unique), 4)
+        self.assertTrue(np.array_equal(unique[inverse], Nd[rows]))
+
+    def test_table_resolution_follows_bin_layout(self):
+        D_max, num_points, error = scattering.table_resolution(
+            self.bin_edges, accuracy=0.1)
+        self.assertEqual(D_max, scattering.DEFAULT_D_MAX)
+        self.assertLessEqual(error, 0.1)
+        self.assertAlmostEqual(
+            error, scattering.quadrature_error(self.bin_edges, D_max,
+                                               num_points))
+
+        coarse_edges = np.linspace(0.3, 5.5, 21)
+        D_max, coarse_points, error = scattering.table_resolution(
+            coarse_edges, accuracy=0.1)
+        self.assertEqual(D_max, 5.5)
+        self.assertLess(coarse_points, num_points)
+        self.assertLessEqual(error, 0.1)
@@ -0,0 +1,70 @@
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from pytmatrix import tmatrix_aux
+
+from .. import DSR
+from ..utility import scattering
+from ..utility.scattering_cache import ScatteringTableCache
+
+
+class TestScatteringTableCache(unittest.TestCase):
+    """Test module for the on disk scattering table cache"""
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = ScatteringTableCache(self.cache_dir)
+        self.wavelength = 30.0
+        self.m = complex(7.99, 2.2)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def _build(self, dsr_func=DSR.bc, wavelength=None):
+        return scattering.build_scatterer(
+            wavelength or self.wavelength, self.m, dsr_func, num_points=8,
+            cache=self.cache)
+
+    def test_second_build_is_read_from_cache(self):
+        first = self._build()
+        second = self._build()
+        self.assertEqual(self.cache.misses, 1)
+        self.assertEqual(self.cache.hits, 1)
+        geom = tmatrix_aux.geom_horiz_back
+        self.assertTrue(np.allclose(first.psd_integrator._Z_table[geom],
+                                    second.psd_integrator._Z_table[geom]))
+        self.assertTrue(np.array_equal(first.psd_integrator._S_table[geom],
+                                       second.psd_integrator._S_table[geom]))
+        self.assertEqual(first.psd_integrator.geometries,
+                         second.psd_integrator.geometries)
+
+    def test_pickled_entries_are_not_loaded(self):
+        scatterer = self._build()
+        path = self.cache.path(self.cache.key(scatterer))
+        with open(path, 'wb') as f:
+            pickle.dump({'description': 'table'}, f)
+        self._build()
+        self.assertEqual(self.cache.misses, 2)
+        with np.load(path, allow_pickle=False) as data:
+            self.assertIn('Z_table', data)
+
+    def test_key_depends_on_inputs(self):
+        self._build()
+        self._build(dsr_func=DSR.pb)
+        self._build(wavelength=50.0)
+        self.assertEqual(self.cache.misses, 3)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 3)
+
+    def test_eviction_keeps_cache_under_max_size(self):
+        self._build()
+        size = os.path.getsize(os.path.join(self.cache_dir,
+                                            os.listdir(self.cache_dir)[0]))
+        self.cache.max_size = size
+        self._build(dsr_func=DSR.pb)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        self._build(dsr_func=DSR.pb)
+        self.assertEqual(self.cache.hits, 1)
@@ -22,9 +22,21 @@ class Configuration(object):
         return json.load(open(self.metadata_config_file))
 
 
-    def fill_in_metadata(self, field, data):
+    def fill_in_metadata(self, field, data, copy_data=True):
+        ''' Return the metadata of field with data filled in.
+
+        Parameters:
+        -----------
+        field: str
+            Name of the field in the metadata configuration.
+        data: array_like
+            Data of the field.
+        copy_data: optional, bool
+            Store a copy of data. Pass False for freshly created arrays
+            that are not shared, to avoid the extra copy.
+        '''
         metadata = self.metadata[field].copy()
-        metadata['data'] = copy(data)
+        metadata['data'] = copy(data) if copy_data else data
         return metadata
 
 
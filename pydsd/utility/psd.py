@@ -0,0 +1,49 @@
+'''
+Vectorized particle size distribution models. These evaluate many
+distributions at once, matching the definitions used in pytmatrix.psd.
+'''
+
+import numpy as np
+from scipy.special import gamma
+
+
+def normalized_gamma(D, D0, Nw, mu, D_max=None):
+    ''' Evaluate normalized gamma distributions at diameters D.
+
+    Vectorized version of `pytmatrix.psd.GammaPSD`:
+    N(D) = Nw * f(mu) * (D/D0)**mu * exp(-(3.67+mu)*D/D0)
+    f(mu) = 6/(3.67**4) * (3.67+mu)**(mu+4)/Gamma(mu+4)
+
+    Parameters
+    ----------
+    D: array_like
+        Diameters [mm], shape (nD,).
+    D0: array_like
+        Median volume diameters [mm], shape (n,).
+    Nw: array_like
+        Normalized intercept parameters, shape (n,).
+    mu: array_like
+        Shape parameters, shape (n,).
+    D_max: optional, array_like
+        Maximum diameters, defaults to 3*D0 like pytmatrix.
+
+    Returns
+    -------
+    psd: array
+        Distribution values of shape (n, nD). Zero above D_max and at D=0.
+    '''
+    D = np.asarray(D, dtype=float)
+    D0 = np.atleast_1d(np.asarray(D0, dtype=float))[:, np.newaxis]
+    Nw = np.atleast_1d(np.asarray(Nw, dtype=float))[:, np.newaxis]
+    mu = np.atleast_1d(np.asarray(mu, dtype=float))[:, np.newaxis]
+    if D_max is None:
+        D_max = 3.0 * D0
+    else:
+        D_max = np.atleast_1d(np.asarray(D_max, dtype=float))[:, np.newaxis]
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        nf = Nw * 6.0 / 3.67 ** 4 * (3.67 + mu) ** (mu + 4) / gamma(mu + 4)
+        d = D / D0
+        psd = nf * np.exp(mu * np.log(d) - (3.67 + mu) * d)
+    psd[(D > D_max) | (D == 0.0)] = 0.0
+    return psd
@@ -0,0 +1,635 @@
+'''
+The scattering module builds the pytmatrix scatterers used for the radar
+simulations of drop size distributions and integrates their scattering
+tables over binned drop size distributions.
+
+For a fixed set of bin edges the PSD integration done by pytmatrix is linear
+in the bin concentrations, so the scattering table can be collapsed once into
+a per-bin kernel and all timesteps integrated with a single matrix product.
+'''
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from pytmatrix.tmatrix import Scatterer
+from pytmatrix.psd import PSDIntegrator, BinnedPSD
+from pytmatrix import orientation, tmatrix_aux
+
+BACK = tmatrix_aux.geom_horiz_back
+FORW = tmatrix_aux.geom_horiz_forw
+
+BACKWARD_FIELDS = ['Zh', 'Zv', 'Zdr', 'cross_correlation_ratio_hv',
+                   'specific_differential_phase_hv', 'LDR']
+FORWARD_FIELDS = ['Kdp', 'Ai', 'Av', 'Adr']
+RADAR_FIELDS = BACKWARD_FIELDS + FORWARD_FIELDS
+
+# IEEE radar bands and their upper frequency limit [Hz].
+RADAR_BANDS = [('L', 2e9), ('S', 4e9), ('C', 8e9), ('X', 12e9),
+               ('Ku', 18e9), ('K', 27e9), ('Ka', 40e9), ('V', 75e9),
+               ('W', 110e9)]
+
+# Default scattering table layout.
+DEFAULT_D_MAX = 10.0
+DEFAULT_NUM_POINTS = 1024
+DEFAULT_CANTING_STD = 20.0
+
+# Scatterers available in this process, keyed by their build arguments.
+# Worker processes fill this once, or inherit it from the parent by fork.
+_scatterers = {}
+
+
+def build_scatterer(wavelength, m, dsr_func, D_max=DEFAULT_D_MAX,
+                    canting_std=DEFAULT_CANTING_STD,
+                    num_points=DEFAULT_NUM_POINTS, cache=None,
+                    geometries=(BACK, FORW)):
+    ''' Create a scatterer with an initialized scattering table.
+
+    The table holds the horizontal backward and forward geometries by
+    default. When a cache is given, the table is loaded from it if
+    available and stored in it otherwise.
+
+    Parameters:
+    -----------
+        wavelength: float
+            Wavelength [mm].
+        m: complex
+            Complex refractive index of water.
+        dsr_func: function
+            Drop Shape Relationship function. Several built-in
+            are available in the `DSR` module.
+        D_max: optional, float
+            Largest diameter of the table [mm].
+        canting_std: optional, float
+            Standard deviation of the gaussian canting angle distribution
+            [degrees].
+        num_points: optional, int
+            Number of diameters in the table.
+        cache: optional, `ScatteringTableCache`
+            On disk cache of scattering tables.
+        geometries: optional, tuple
+            Scattering geometries of the table. Building only the
+            geometries that are needed saves the T-matrix computations of
+            the others, see `field_geometries`.
+
+    Returns:
+    --------
+        scatterer: pytmatrix Scatterer
+            Scatterer with the scattering table initialized.
+    '''
+    scatterer = Scatterer(wavelength=wavelength, m=m)
+    scatterer.psd_integrator = PSDIntegrator()
+    scatterer.psd_integrator.axis_ratio_func = lambda D: 1.0 / dsr_func(D)
+    scatterer.psd_integrator.D_max = D_max
+    scatterer.psd_integrator.num_points = num_points
+    scatterer.psd_integrator.geometries = tuple(geometries)
+    scatterer.or_pdf = orientation.gaussian_pdf(canting_std)
+    scatterer.orient = orientation.orient_averaged_fixed
+
+    if cache is not None and cache.load(scatterer):
+        return scatterer
+
+    scatterer.psd_integrator.init_scatter_table(scatterer)
+    if cache is not None:
+        cache.save(scatterer)
+    return scatterer
+
+
+def integrate_binned(scatterer, bin_edges, Nd, geometries=None):
+    ''' Integrate the scattering table over each DSD with pytmatrix.
+
+    This is the reference implementation, building a `BinnedPSD` for every
+    timestep and letting the scatterer's PSDIntegrator do the integration.
+
+    Parameters:
+    -----------
+        scatterer: pytmatrix Scatterer
+            Scatterer with an initialized scattering table.
+        bin_edges: array_like
+            N+1 bin edges of the size bins [mm].
+        Nd: 2d array
+            Drop size distributions, one row per timestep.
+        geometries: optional, tuple
+            Scattering geometries to integrate. Defaults to all geometries
+            of the scattering table.
+
+    Returns:
+    --------
+        integrated: dict
+            Maps each geometry to a tuple (S, Z) of arrays with shapes
+            (nt, 2, 2) and (nt, 4, 4).
+    '''
+    Nd = np.ma.filled(Nd, 0)
+    if geometries is None:
+        geometries = scatterer.psd_integrator.geometries
+    integrated = {}
+    for geom in geometries:
+        S = np.zeros((len(Nd), 2, 2), dtype=complex)
+        Z = np.zeros((len(Nd), 4, 4))
+        scatterer.set_geometry(geom)
+        for t in range(len(Nd)):
+            scatterer.psd = BinnedPSD(bin_edges, Nd[t])
+            S[t], Z[t] = scatterer.get_SZ()
+        integrated[geom] = (S, Z)
+    return integrated
+
+
+def register_scatterer(setup, scatterer):
+    ''' Make a scatterer available to `integrate_binned_parallel`.
+
+    Registering the scatterer in the parent process lets forked workers
+    inherit it instead of building their own table.
+
+    Parameters:
+    -----------
+        setup: tuple
+            Positional arguments of `build_scatterer` used to create it.
+        scatterer: pytmatrix Scatterer
+            Scatterer with an initialized scattering table.
+    '''
+    _scatterers.clear()
+    _scatterers[setup] = scatterer
+
+
+def get_scatterer(setup, cache=None):
+    ''' Return the registered scatterer for setup, building it if needed.
+
+    Parameters:
+    -----------
+        setup: tuple
+            Positional arguments of `build_scatterer`.
+        cache: optional, `ScatteringTableCache`
+            On disk cache of scattering tables.
+
+    Returns:
+    --------
+        scatterer: pytmatrix Scatterer
+            Scatterer with an initialized scattering table.
+    '''
+    if setup not in _scatterers:
+        register_scatterer(setup, build_scatterer(*setup, cache=cache))
+    return _scatterers[setup]
+
+
+def _integrate_binned_chunk(setup, cache, bin_edges, Nd, geometries):
+    return integrate_binned(get_scatterer(setup, cache), bin_edges, Nd,
+                            geometries)
+
+
+def integrate_binned_parallel(setup, bin_edges, Nd, geometries=(BACK, FORW),
+                              n_workers=None, executor=None, cache=None):
+    ''' Run `integrate_binned` over chunks of timesteps in a process pool.
+
+    Each worker uses one scatterer for all of its chunks. It is inherited
+    from the parent when the pool forks after `register_scatterer`, and
+    otherwise built once per worker (from `cache` when one is given).
+
+    Parameters:
+    -----------
+        setup: tuple
+            Positional arguments of `build_scatterer`.
+        bin_edges: array_like
+            N+1 bin edges of the size bins [mm].
+        Nd: 2d array
+            Drop size distributions, one row per timestep.
+        geometries: optional, tuple
+            Scattering geometries to integrate.
+        n_workers: optional, int
+            Number of worker processes. Defaults to the number of CPUs.
+        executor: optional, concurrent.futures.Executor
+            Executor to submit the chunks to instead of creating a pool.
+        cache: optional, `ScatteringTableCache`
+            Cache used by workers that have to build their scatterer.
+
+    Returns:
+    --------
+        integrated: dict
+            Maps each geometry to a tuple (S, Z) of arrays with shapes
+            (nt, 2, 2) and (nt, 4, 4), in timestep order.
+    '''
+    Nd = np.ma.filled(Nd, 0)
+    n_workers = n_workers or multiprocessing.cpu_count()
+    chunks = np.array_split(Nd, min(len(Nd), 4 * n_workers) or 1)
+
+    own_executor = executor is None
+    if own_executor:
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+        else:
+            context = None
+        executor = ProcessPoolExecutor(n_workers, mp_context=context)
+    try:
+        futures = [executor.submit(_integrate_binned_chunk, setup, cache,
+                                   bin_edges, chunk, geometries)
+                   for chunk in chunks]
+        results = [future.result() for future in futures]
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+    integrated = {}
+    for geom in geometries:
+        integrated[geom] = (
+            np.concatenate([result[geom][0] for result in results]),
+            np.concatenate([result[geom][1] for result in results]))
+    return integrated
+
+
+def bin_kernels(scatterer, bin_edges, geometries=None):
+    ''' Collapse the scattering table into per-bin kernels.
+
+    The kernel of a bin is the table integrated over the diameters falling
+    in that bin, using the same bin assignment and trapezoidal weights as
+    pytmatrix does for a `BinnedPSD`.
+
+    Parameters:
+    -----------
+        scatterer: pytmatrix Scatterer
+            Scatterer with an initialized scattering table.
+        bin_edges: array_like
+            N+1 bin edges of the size bins [mm].
+        geometries: optional, tuple
+            Scattering geometries to build kernels for. Defaults to all
+            geometries of the scattering table.
+
+    Returns:
+    --------
+        kernels: dict
+            Maps each geometry to a tuple (S, Z) of arrays with shapes
+            (nbins, 2, 2) and (nbins, 4, 4).
+    '''
+    integrator = scatterer.psd_integrator
+    if geometries is None:
+        geometries = integrator.geometries
+    membership = _bin_weights(integrator._psd_D, bin_edges)
+
+    kernels = {}
+    for geom in geometries:
+        kernels[geom] = (
+            np.einsum('kd,ijd->kij', membership, integrator._S_table[geom]),
+            np.einsum('kd,ijd->kij', membership, integrator._Z_table[geom]))
+    return kernels
+
+
+def _bin_weights(D, bin_edges):
+    ''' Quadrature weights of the table diameters D in each size bin. '''
+    bin_edges = np.asarray(bin_edges, dtype=float)
+    nbins = len(bin_edges) - 1
+    weights = _trapz_weights(D)
+
+    # Bin k covers bin_edges[k] < D <= bin_edges[k + 1], as in BinnedPSD.
+    idx = np.searchsorted(bin_edges, D, side='left') - 1
+    in_bins = (idx >= 0) & (idx < nbins)
+    membership = np.zeros((nbins, len(D)))
+    membership[idx[in_bins], np.nonzero(in_bins)[0]] = weights[in_bins]
+    return membership
+
+
+def table_diameters(D_max, num_points):
+    ''' Diameters of a scattering table, as sampled by pytmatrix. '''
+    return np.linspace(D_max / num_points, D_max, num_points)
+
+
+def quadrature_error(bin_edges, D_max, num_points, moment=0):
+    ''' Expected relative integration error of a table over size bins.
+
+    Integrates D**moment over every bin with the table diameters and the
+    quadrature used for binned spectra, and compares it to the exact
+    integral. The error is dominated by the table diameters not falling on
+    the bin edges, and so scales with the table spacing over the bin
+    width. Higher moments weigh the upper bin edge more and give larger
+    errors for the smallest bins.
+
+    Parameters:
+    -----------
+        bin_edges: array_like
+            N+1 bin edges of the size bins [mm].
+        D_max: float
+            Largest diameter of the table [mm].
+        num_points: int
+            Number of diameters in the table.
+        moment: optional, float
+            Power of the diameter used as test integrand.
+
+    Returns:
+    --------
+        error: float
+            Largest relative error over the bins below D_max.
+    '''
+    bin_edges = np.asarray(bin_edges, dtype=float)
+    D = table_diameters(D_max, num_points)
+    quadrature = np.dot(_bin_weights(D, bin_edges), D ** moment)
+    lower = bin_edges[:-1]
+    upper = np.minimum(bin_edges[1:], D_max)
+    covered = upper > lower
+    exact = (upper[covered] ** (moment + 1) -
+             lower[covered] ** (moment + 1)) / (moment + 1)
+    return np.max(np.abs(quadrature[covered] - exact) / exact)
+
+
+def table_resolution(bin_edges, accuracy=0.01,
+                     max_diameter=DEFAULT_D_MAX, max_points=4096,
+                     min_points=32):
+    ''' Choose the scattering table layout for an instrument's size bins.
+
+    D_max is the upper edge of the last bin, capped at max_diameter, and the
+    table spacing is chosen so that the relative integration error of the
+    narrowest bin is at most accuracy, if max_points allows.
+
+    Parameters:
+    -----------
+        bin_edges: array_like
+            N+1 bin edges of the size bins [mm].
+        accuracy: optional, float
+            Target relative integration error per bin.
+        max_diameter: optional, float
+            Largest diameter worth scattering [mm].
+        max_points: optional, int
+            Upper limit on the number of table diameters.
+        min_points: optional, int
+            Lower limit on the number of table diameters.
+
+    Returns:
+    --------
+        D_max: float
+            Largest diameter of the table [mm].
+        num_points: int
+            Number of diameters in the table.
+        error: float
+            Expected relative integration error, see `quadrature_error`.
+            It exceeds accuracy when max_points is reached.
+    '''
+    bin_edges = np.asarray(bin_edges, dtype=float)
+    D_max = float(min(bin_edges[-1], max_diameter))
+    widths = np.minimum(bin_edges[1:], D_max) - bin_edges[:-1]
+    step = accuracy * widths[widths > 0].min()
+    num_points = int(np.clip(np.ceil(D_max / step), min_points, max_points))
+    error = quadrature_error(bin_edges, D_max, num_points)
+    # The edge alignment makes the error jitter around the estimate.
+    while error > accuracy and num_points < max_points:
+        num_points = min(int(num_points * 1.1) + 1, max_points)
+        error = quadrature_error(bin_edges, D_max, num_points)
+    return D_max, num_points, error
+
+
+def _build_kernels(setup, cache, bin_edges):
+    scatterer = build_scatterer(*setup, cache=cache)
+    return bin_kernels(scatterer, bin_edges), scatterer.Kw_sqr
+
+
+def build_kernels(setups, bin_edges, n_workers=None, cache=None):
+    ''' Build scattering tables and bin kernels for several setups.
+
+    The tables are computed concurrently in a process pool when n_workers
+    is given. Only the kernels are sent back, so the tables never have to
+    be transferred between processes.
+
+    Parameters:
+    -----------
+        setups: list of tuple
+            Positional arguments of `build_scatterer` for each table.
+        bin_edges: array_like
+            N+1 bin edges of the size bins [mm].
+        n_workers: optional, int
+            Number of worker processes. Tables are built serially if None.
+        cache: optional, `ScatteringTableCache`
+            On disk cache of scattering tables.
+
+    Returns:
+    --------
+        kernels: list of tuple
+            (kernels, Kw_sqr) for each setup, in order.
+    '''
+    if not n_workers:
+        return [_build_kernels(setup, cache, bin_edges) for setup in setups]
+
+    with ProcessPoolExecutor(min(n_workers, len(setups))) as executor:
+        futures = [executor.submit(_build_kernels, setup, cache, bin_edges)
+                   for setup in setups]
+        return [future.result() for future in futures]
+
+
+def frequency_band(frequency):
+    ''' Return the IEEE radar band letter of a frequency.
+
+    Parameters:
+    -----------
+        frequency: float
+            Frequency [Hz].
+
+    Returns:
+    --------
+        band: str
+            Band letter, e.g. 'X' for 9.7e9.
+    '''
+    for band, upper in RADAR_BANDS:
+        if frequency < upper:
+            return band
+    raise ValueError("No radar band defined for %g Hz" % frequency)
+
+
+def integrate_psd(scatterer, psd_values, geometries=None):
+    ''' Integrate the scattering table over PSDs sampled on its diameters.
+
+    This gives the same result as the scatterer's PSDIntegrator for many
+    distributions at once, with the distributions evaluated at the table
+    diameters `scatterer.psd_integrator._psd_D`.
+
+    Parameters:
+    -----------
+        scatterer: pytmatrix Scatterer
+            Scatterer with an initialized scattering table.
+        psd_values: 2d array
+            PSD values, one row per distribution and one column per table
+            diameter.
+        geometries: optional, tuple
+            Scattering geometries to integrate. Defaults to all geometries
+            of the scattering table.
+
+    Returns:
+    --------
+        integrated: dict
+            Maps each geometry to a tuple (S, Z) of arrays with shapes
+            (n, 2, 2) and (n, 4, 4).
+    '''
+    integrator = scatterer.psd_integrator
+    if geometries is None:
+        geometries = integrator.geometries
+    psd_w = psd_values * _trapz_weights(integrator._psd_D)
+    integrated = {}
+    for geom in geometries:
+        integrated[geom] = (
+            np.tensordot(psd_w, integrator._S_table[geom], axes=(1, 2)),
+            np.tensordot(psd_w, integrator._Z_table[geom], axes=(1, 2)))
+    return integrated
+
+
+def _trapz_weights(D):
+    ''' Trapezoidal quadrature weights for the diameters D. '''
+    dD = np.diff(D)
+    weights = np.zeros(len(D))
+    weights[:-1] += dD / 2.0
+    weights[1:] += dD / 2.0
+    return weights
+
+
+def integrate_kernels(kernels, Nd, geometries=None):
+    ''' Integrate precomputed bin kernels over each DSD.
+
+    Parameters:
+    -----------
+        kernels: dict
+            Kernels returned by `bin_kernels`.
+        Nd: 2d array
+            Drop size distributions, one row per timestep.
+        geometries: optional, tuple
+            Scattering geometries to integrate. Defaults to all geometries
+            of the kernels.
+
+    Returns:
+    --------
+        integrated: dict
+            Maps each geometry to a tuple (S, Z) of arrays with shapes
+            (nt, 2, 2) and (nt, 4, 4).
+    '''
+    Nd = np.ma.filled(Nd, 0)
+    if geometries is None:
+        geometries = kernels.keys()
+    integrated = {}
+    for geom in geometries:
+        S_k, Z_k = kernels[geom]
+        integrated[geom] = (np.tensordot(Nd, S_k, axes=1),
+                            np.tensordot(Nd, Z_k, axes=1))
+    return integrated
+
+
+def unique_spectra(Nd):
+    ''' Find the distinct non-empty drop size distributions.
+
+    Parameters:
+    -----------
+        Nd: 2d array
+            Drop size distributions, one row per timestep.
+
+    Returns:
+    --------
+        rows: array
+            Indices of the non-empty rows of Nd.
+        unique: 2d array
+            Distinct spectra among those rows.
+        inverse: array
+            Index into unique for each entry of rows, so that
+            unique[inverse] == Nd[rows].
+    '''
+    Nd = np.ascontiguousarray(np.ma.filled(Nd, 0), dtype=float)
+    rows = np.nonzero(np.any(Nd != 0, axis=1))[0]
+    # Hash whole rows at once by viewing each one as a single opaque item.
+    keys = Nd[rows].view(np.dtype((np.void, Nd.dtype.itemsize *
+                                   Nd.shape[1]))).ravel()
+    _, first, inverse = np.unique(keys, return_index=True,
+                                  return_inverse=True)
+    return rows, Nd[rows[first]], inverse.ravel()
+
+
+def field_geometries(fields=None):
+    ''' Return the scattering geometries needed for some radar fields.
+
+    Parameters:
+    -----------
+        fields: optional, list of str
+            Radar field names out of `RADAR_FIELDS`. Defaults to all.
+
+    Returns:
+    --------
+        geometries: tuple
+            The backward geometry if any backward scattering field is
+            requested, followed by the forward one if any forward
+            scattering field is.
+    '''
+    if fields is None:
+        fields = RADAR_FIELDS
+    unknown = set(fields) - set(RADAR_FIELDS)
+    if unknown:
+        raise ValueError("Unknown radar fields: %s" %
+                         ", ".join(sorted(unknown)))
+    geometries = ()
+    if set(fields) & set(BACKWARD_FIELDS):
+        geometries += (BACK,)
+    if set(fields) & set(FORWARD_FIELDS):
+        geometries += (FORW,)
+    return geometries
+
+
+def radar_variables(integrated, wavelength, Kw_sqr=0.93, fields=None):
+    ''' Compute the polarimetric radar variables from integrated S and Z.
+
+    This is a vectorized version of the pytmatrix `radar` functions, applied
+    to all timesteps at once. Cross sections and attenuations shared by
+    several fields are computed only once.
+
+    Parameters:
+    -----------
+        integrated: dict
+            Maps geometries to (S, Z) tuples as returned by
+            `integrate_binned` or `integrate_kernels`.
+        wavelength: float
+            Wavelength [mm].
+        Kw_sqr: optional, float
+            Reference water dielectric factor.
+        fields: optional, list of str
+            Radar fields to compute. Defaults to all of `RADAR_FIELDS`.
+
+    Returns:
+    --------
+        variables: dict
+            Radar variables keyed by field name. Backward scattering
+            variables are only present if the backward geometry was
+            integrated, and likewise for forward scattering variables.
+    '''
+    wanted = set(RADAR_FIELDS if fields is None else fields)
+    rho_hv = 'cross_correlation_ratio_hv'
+    variables = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if BACK in integrated and wanted & set(BACKWARD_FIELDS):
+            Z = integrated[BACK][1]
+            if wanted & set(['Zh', 'Zdr', rho_hv]):
+                xsect_h = 2 * np.pi * (Z[:, 0, 0] - Z[:, 0, 1] -
+                                       Z[:, 1, 0] + Z[:, 1, 1])
+            if wanted & set(['Zv', 'Zdr', rho_hv]):
+                xsect_v = 2 * np.pi * (Z[:, 0, 0] + Z[:, 0, 1] +
+                                       Z[:, 1, 0] + Z[:, 1, 1])
+            refl_const = wavelength ** 4 / (np.pi ** 5 * Kw_sqr)
+            if 'Zh' in wanted:
+                variables['Zh'] = 10 * np.log10(refl_const * xsect_h)
+            if 'Zv' in wanted:
+                variables['Zv'] = 10 * np.log10(refl_const * xsect_v)
+            if 'Zdr' in wanted:
+                variables['Zdr'] = 10 * np.log10(xsect_h / xsect_v)
+            if rho_hv in wanted:
+                a = (Z[:, 2, 2] + Z[:, 3, 3]) ** 2 + \
+                    (Z[:, 3, 2] - Z[:, 2, 3]) ** 2
+                variables[rho_hv] = np.sqrt(
+                    a / (xsect_h * xsect_v / (2 * np.pi) ** 2))
+            if 'specific_differential_phase_hv' in wanted:
+                variables['specific_differential_phase_hv'] = np.arctan2(
+                    Z[:, 2, 3] - Z[:, 3, 2], -Z[:, 2, 2] - Z[:, 3, 3])
+            if 'LDR' in wanted:
+                variables['LDR'] = 10 * np.log10(
+                    (Z[:, 0, 0] - Z[:, 0, 1] + Z[:, 1, 0] - Z[:, 1, 1]) /
+                    (Z[:, 0, 0] - Z[:, 0, 1] - Z[:, 1, 0] + Z[:, 1, 1]))
+        if FORW in integrated and wanted & set(FORWARD_FIELDS):
+            S = integrated[FORW][0]
+            if 'Kdp' in wanted:
+                variables['Kdp'] = 1e-3 * (180.0 / np.pi) * wavelength * \
+                    (S[:, 1, 1] - S[:, 0, 0]).real
+            if wanted & set(['Ai', 'Adr']):
+                Ai = 4.343e-3 * (2 * wavelength * S[:, 1, 1].imag)
+            if wanted & set(['Av', 'Adr']):
+                Av = 4.343e-3 * (2 * wavelength * S[:, 0, 0].imag)
+            if 'Ai' in wanted:
+                variables['Ai'] = Ai
+            if 'Av' in wanted:
+                variables['Av'] = Av
+            if 'Adr' in wanted:
+                variables['Adr'] = Ai - Av
+    return variables
@@ -0,0 +1,261 @@
+'''
+The scattering_cache module stores T-matrix scattering tables on disk so that
+they only have to be computed once for a given scattering setup.
+
+Tables are content addressed: the file name is a hash of everything that
+goes into the table (wavelength, refractive index, the axis ratios sampled
+on the table diameters, D_max, number of points, the orientation pdf and
+geometries) together with the pytmatrix version and the cache format version.
+Bumping either version invalidates all previously stored tables. The total
+size of the cache directory is capped and the least recently used tables are
+evicted first.
+
+Tables are stored as plain arrays in .npz files and read without unpickling,
+so that a cache directory shared through PYDSD_SCATTERING_CACHE cannot be
+used to run code in the processes that read it.
+'''
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+from pytmatrix import tmatrix_aux
+
+CACHE_FORMAT_VERSION = 2
+CACHE_DIR_ENV = 'PYDSD_SCATTERING_CACHE'
+DEFAULT_MAX_SIZE = 1024 ** 3  # bytes
+
+# Order of the angular integration tables in the stored arrays.
+_ANGULAR_VARS = ('sca_xsect', 'ext_xsect', 'asym')
+_ANGULAR_POLS = ('h_pol', 'v_pol')
+
+# Angles at which the orientation pdf is sampled for the table key.
+_CANTING_ANGLES = np.linspace(0.0, 180.0, 181)
+
+
+def default_cache():
+    ''' Return the cache configured through the environment.
+
+    Returns a `ScatteringTableCache` rooted at the directory given by the
+    PYDSD_SCATTERING_CACHE environment variable, or None if it is not set.
+    '''
+    cache_dir = os.environ.get(CACHE_DIR_ENV)
+    if cache_dir:
+        return ScatteringTableCache(cache_dir)
+    return None
+
+
+class ScatteringTableCache(object):
+    ''' On disk cache of pytmatrix scattering tables.
+
+    Attributes
+    ----------
+        cache_dir: str
+            Directory holding the cached tables.
+        max_size: int
+            Maximum total size of the cache directory in bytes. Least
+            recently used tables are removed when this is exceeded.
+        hits: int
+            Number of tables loaded from the cache.
+        misses: int
+            Number of tables that had to be computed.
+    '''
+
+    suffix = '.npz'
+
+    def __init__(self, cache_dir, max_size=DEFAULT_MAX_SIZE):
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def key(self, scatterer):
+        ''' Compute the content key of the table for a scatterer.
+
+        The scatterer must have its psd_integrator configured, but the
+        table does not need to be initialized.
+
+        Parameters:
+        -----------
+            scatterer: pytmatrix Scatterer
+                Scatterer with a configured PSDIntegrator.
+
+        Returns:
+        --------
+            key: str
+                Hex digest identifying the table.
+        '''
+        return table_key(scatterer)[0]
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + self.suffix)
+
+    def load(self, scatterer):
+        ''' Load the table for `scatterer` from the cache if present.
+
+        Returns True when the table was found and loaded into the
+        scatterer's psd_integrator, False otherwise.
+        '''
+        key, description = table_key(scatterer)
+        path = self.path(key)
+        if not os.path.exists(path):
+            self.misses += 1
+            return False
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                tables = dict(data.items())
+            stored = str(tables['description'])
+        except Exception:
+            stored = None
+        if stored == description:
+            try:
+                _set_tables(scatterer.psd_integrator, tables)
+            except Exception:
+                stored = None
+        if stored != description:
+            # Corrupt or colliding entry, drop it and recompute.
+            self._remove(path)
+            self.misses += 1
+            return False
+        # Touch the file so that eviction is least recently used.
+        os.utime(path, None)
+        self.hits += 1
+        return True
+
+    def save(self, scatterer):
+        ''' Store the initialized table of `scatterer` in the cache. '''
+        key, description = table_key(scatterer)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir,
+                                        suffix='.tmp')
+        os.close(fd)
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, description=np.array(description),
+                         **_get_tables(scatterer.psd_integrator))
+            os.replace(tmp_path, self.path(key))
+        finally:
+            self._remove(tmp_path)
+        self.evict()
+
+    def evict(self):
+        ''' Remove least recently used tables until under max_size. '''
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(self.suffix):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(entry[1] for entry in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            self._remove(path)
+            total -= size
+
+    def clear(self):
+        ''' Remove all tables from the cache. '''
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(self.suffix):
+                self._remove(os.path.join(self.cache_dir, name))
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _get_tables(integrator):
+    ''' Return the scattering tables of an initialized PSDIntegrator as
+    plain arrays, with the geometries along the first axis. '''
+    geometries = [tuple(g) for g in integrator.geometries]
+    tables = {
+        'num_points': np.array(integrator.num_points),
+        'D_max': np.array(integrator.D_max),
+        'psd_D': np.asarray(integrator._psd_D),
+        'm_table': np.asarray(integrator._m_table, dtype=complex),
+        'geometries': np.array(geometries, dtype=float),
+        'S_table': np.array([integrator._S_table[g] for g in geometries]),
+        'Z_table': np.array([integrator._Z_table[g] for g in geometries]),
+    }
+    angular = integrator._angular_table
+    if angular is not None:
+        tables['angular_table'] = np.array(
+            [[[angular[var][pol][g] for g in geometries]
+              for pol in _ANGULAR_POLS] for var in _ANGULAR_VARS])
+    return tables
+
+
+def _set_tables(integrator, tables):
+    ''' Restore the scattering tables stored by `_get_tables`. '''
+    geometries = tuple(tuple(map(float, g)) for g in tables['geometries'])
+    S_table = dict(zip(geometries, tables['S_table']))
+    Z_table = dict(zip(geometries, tables['Z_table']))
+    angular_table = None
+    if 'angular_table' in tables:
+        angular_table = dict(
+            (var, dict((pol, dict(zip(geometries, pol_tables)))
+                       for pol, pol_tables in zip(_ANGULAR_POLS, var_tables)))
+            for var, var_tables in zip(_ANGULAR_VARS,
+                                       tables['angular_table']))
+    integrator.num_points = int(tables['num_points'])
+    integrator.D_max = float(tables['D_max'])
+    integrator._psd_D = tables['psd_D']
+    integrator._m_table = tables['m_table']
+    integrator.geometries = geometries
+    integrator._S_table = S_table
+    integrator._Z_table = Z_table
+    integrator._angular_table = angular_table
+    integrator._previous_psd = None
+
+
+def table_key(scatterer):
+    ''' Build the content key and description for a scattering table.
+
+    Parameters:
+    -----------
+        scatterer: pytmatrix Scatterer
+            Scatterer with a configured PSDIntegrator.
+
+    Returns:
+    --------
+        key: str
+            Hex digest of the description.
+        description: str
+            JSON description of every input of the table.
+    '''
+    integrator = scatterer.psd_integrator
+    diameters = np.linspace(integrator.D_max / integrator.num_points,
+                            integrator.D_max, integrator.num_points)
+    if integrator.axis_ratio_func is not None:
+        axis_ratio = [float(integrator.axis_ratio_func(d))
+                      for d in diameters]
+    else:
+        axis_ratio = [float(scatterer.axis_ratio)]
+
+    params = {
+        'cache_version': CACHE_FORMAT_VERSION,
+        'pytmatrix_version': tmatrix_aux.VERSION,
+        'wavelength': float(scatterer.wavelength),
+        'm': [float(np.real(scatterer.m)), float(np.imag(scatterer.m))],
+        'D_max': float(integrator.D_max),
+        'num_points': int(integrator.num_points),
+        'geometries': [list(map(float, g)) for g in integrator.geometries],
+        'orient': getattr(scatterer.orient, '__name__', None),
+        'or_pdf_sha1': hashlib.sha1(np.asarray(
+            [float(scatterer.or_pdf(b)) for b in _CANTING_ANGLES]
+        ).tobytes()).hexdigest(),
+        'axis_ratio_sha1': hashlib.sha1(
+            np.asarray(axis_ratio).tobytes()).hexdigest(),
+    }
+    description = json.dumps(params, sort_keys=True)
+    return hashlib.sha1(description.encode('utf-8')).hexdigest(), description